@@ -0,0 +1,202 @@
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from main import NullSink, Phone, TelephoneSystem
+
+# Benchmark suite: a seeded traffic generator drives the public TelephoneSystem
+# methods over synthetic directories and reports throughput, per-command latency
+# percentiles and peak memory. Results can be saved as a baseline and later runs
+# compared against it.
+
+DEFAULT_SIZES = (10, 1000, 100000, 1000000)
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def phone_name(i):
+    # Unique alphabetic name for the i-th synthetic phone
+    name = ''
+    while True:
+        name = chr(ord('a') + i % 26) + name
+        i //= 26
+        if not i:
+            return 'P' + name
+
+
+def synthetic_directory(size):
+    # size phones spread over every number prefix; numbers are 5 digits up to 100000
+    # phones and 7 digits beyond that, since the switch itself does not care
+    digits, modulus = (5, 100000) if size <= 100000 else (7, 10000000)
+    step = 99991 if digits == 5 else 9999991  # Prime, so every number is distinct
+    system = TelephoneSystem(sink=NullSink())
+    system.phones = {number: Phone(number, phone_name(i))
+                     for i, number in ((i, f"{(i * step) % modulus:0{digits}d}") for i in range(size))}
+    return system
+
+
+class TrafficProfile:
+    # Shape of the generated traffic; all ratios are probabilities per call
+    def __init__(self, answer=0.8, transfer=0.05, conference=0.05, third_party_answer=0.7,
+                 concurrency=256, by_name=0.1):
+        self.answer = answer                          # Called party picks up; otherwise the caller abandons
+        self.transfer = transfer                      # Answered call is transferred to a third phone
+        self.conference = conference                  # Answered call has a third phone conferenced in
+        self.third_party_answer = third_party_answer  # Transfer/conference target picks up
+        self.concurrency = concurrency                # Calls in progress at once
+        self.by_name = by_name                        # Share of commands addressing a phone by name
+
+
+def call_script(rng, system, numbers, profile):
+    # One call as a list of (method name, args); the phones may turn out busy,
+    # which the switch handles like any other attempt
+    a, b, c = (rng.choice(numbers) for _ in range(3))
+
+    def ident(number):
+        return system.phones[number].name if rng.random() < profile.by_name else number
+
+    ops = [('pickup', (ident(a),)), ('call', (ident(a), ident(b)))]
+    if rng.random() >= profile.answer:
+        ops.append(('onhook', (ident(a),)))  # Abandoned while ringing
+        return ops
+    ops.append(('pickup', (ident(b),)))
+    roll = rng.random()
+    if roll < profile.transfer + profile.conference:
+        verb = 'transfer' if roll < profile.transfer else 'conference'
+        ops.append((verb, (ident(a), ident(c))))
+        ops.append(('pickup' if rng.random() < profile.third_party_answer else 'onhook', (ident(c),)))
+        ops.append(('onhook', (ident(c),)))
+    ops += [('onhook', (ident(a),)), ('onhook', (ident(b),))]
+    return ops
+
+
+def generate_traffic(system, count, seed=0, profile=None):
+    # count operations from interleaved calls, reproducible for a given seed
+    profile = profile or TrafficProfile()
+    rng = random.Random(seed)
+    numbers = list(system.phones)
+    active = []
+    ops = []
+    while len(ops) < count:
+        while len(active) < profile.concurrency:
+            active.append(call_script(rng, system, numbers, profile))
+        position = rng.randrange(len(active))
+        script = active[position]
+        ops.append(script.pop(0))
+        if not script:
+            active[position] = active[-1]
+            active.pop()
+    return ops
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_traffic(system, ops):
+    # Replay ops against the system, timing each call; returns (seconds, {method: [ns]})
+    latencies = {}
+    clock = time.perf_counter_ns
+    start = clock()
+    for name, args in ops:
+        method = getattr(system, name)
+        t0 = clock()
+        method(*args)
+        latencies.setdefault(name, []).append(clock() - t0)
+    return (clock() - start) / 1e9, latencies
+
+
+def peak_memory(size, ops):
+    # Peak traced memory in MB for building the directory and replaying the traffic
+    tracemalloc.start()
+    try:
+        system = synthetic_directory(size)
+        for name, args in ops:
+            getattr(system, name)(*args)
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def bench_size(size, count, seed, memory=True, profile=None):
+    system = synthetic_directory(size)
+    ops = generate_traffic(system, count, seed, profile)
+    elapsed, latencies = run_traffic(system, ops)
+    result = {
+        'phones': size,
+        'ops': len(ops),
+        'ops_per_sec': len(ops) / elapsed if elapsed > 0 else 0.0,
+        'latency_us': {},
+    }
+    for name, samples in sorted(latencies.items()):
+        samples.sort()
+        result['latency_us'][name] = {f"p{round(f * 100)}": percentile(samples, f) / 1000 for f in PERCENTILES}
+    if memory:
+        result['peak_mb'] = peak_memory(size, ops)
+    return result
+
+
+def regressions(results, baseline, tolerance):
+    # Human-readable list of results that are worse than the baseline by more than tolerance
+    found = []
+    for result in results:
+        base = baseline.get(str(result['phones']))
+        if base is None:
+            continue
+        label = f"{result['phones']} phones"
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            found.append(f"{label}: {result['ops_per_sec']:.0f} ops/sec, baseline {base['ops_per_sec']:.0f}")
+        for name, points in result['latency_us'].items():
+            base_p99 = base['latency_us'].get(name, {}).get('p99')
+            if base_p99 and points['p99'] > base_p99 * (1 + tolerance):
+                found.append(f"{label}: {name} p99 {points['p99']:.1f}us, baseline {base_p99:.1f}us")
+        if 'peak_mb' in result and 'peak_mb' in base and result['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            found.append(f"{label}: peak {result['peak_mb']:.1f}MB, baseline {base['peak_mb']:.1f}MB")
+    return found
+
+
+def report(result, stream=None):
+    stream = stream if stream is not None else sys.stdout
+    memory = f", peak {result['peak_mb']:.1f}MB" if 'peak_mb' in result else ''
+    print(f"{result['phones']:>8} phones: {result['ops']} ops, {result['ops_per_sec']:.0f} ops/sec{memory}", file=stream)
+    for name, points in result['latency_us'].items():
+        print(f"{'':>10}{name:<11}" + '  '.join(f"{p}={v:.2f}us" for p, v in points.items()), file=stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TelephoneSystem benchmark suite")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated directory sizes")
+    parser.add_argument('--ops', type=int, default=200000, help="operations per directory size")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced peak-memory pass")
+    parser.add_argument('--save-baseline', metavar='FILE', help="write results as a JSON baseline")
+    parser.add_argument('--baseline', metavar='FILE', help="compare against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before flagging (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in (int(s) for s in args.sizes.split(',')):
+        result = bench_size(size, args.ops, args.seed, memory=not args.no_memory)
+        report(result)
+        results.append(result)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump({str(r['phones']): r for r in results}, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+import array
+import collections
+import glob
+import itertools
+import math
+import operator
+import os
+import struct
+import sys
+import time
+
+from main import CONFERENCE, NORMAL, TRANSFER
+
+# Call detail records. Each record is one row across these columns; rows are
+# kept in arrays and written to disk in chunks, and queries run over whole
+# columns with C-level builtins (Counter, compress, map, bytes.translate).
+CDR_COMPLETED, CDR_MISSED, CDR_TRANSFERRED, CDR_TRANSFER_FAILED, CDR_CONFERENCED, CDR_CONFERENCE_FAILED = range(6)
+OUTCOME_NAMES = ('completed', 'missed', 'transferred', 'transfer_failed', 'conferenced', 'conference_failed')
+UNANSWERED_OUTCOMES = {NORMAL: CDR_MISSED, TRANSFER: CDR_TRANSFER_FAILED, CONFERENCE: CDR_CONFERENCE_FAILED}
+ANSWERED = bytes(1 if code in (CDR_COMPLETED, CDR_TRANSFERRED, CDR_CONFERENCED) else 0 for code in range(256))  # translate table
+CDR_COLUMNS = (('start', 'd'),    # Ringing began, seconds since the epoch
+               ('answer', 'd'),   # Answered, or NaN
+               ('end', 'd'),      # Hung up, transferred away, or stopped ringing
+               ('caller', 'I'),   # Phone ids; CallRecords.numbers maps them back to numbers
+               ('callee', 'I'),
+               ('outcome', 'B'),
+               ('hour', 'B'))     # Hour of the day the call started (UTC), for busy-hour counts
+CDR_MAGIC = b'TCDR\x00\x00\x00\x01'
+CDR_HEADER = struct.Struct('<8sII')  # magic, rows, phones in the summary; then each column's
+                                     # values in CDR_COLUMNS order, then the summary: phone ids
+                                     # and how many of the chunk's records each took part in
+
+
+class CallRecords:
+    # Append-only columnar store of call detail records. The switch reports ringing,
+    # answers, unanswered rings and hang-ups; a record is written when its call
+    # ends. With a directory, every chunk_rows records are written there as one
+    # chunk file and dropped from memory; queries read only the columns they use.
+    def __init__(self, directory=None, chunk_rows=1 << 16, clock=time.time):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.clock = clock
+        self.columns = {name: array.array(code) for name, code in CDR_COLUMNS}
+        self.numbers = []  # Phone id -> number
+        self.ids = {}      # Number -> phone id
+        self.saved_numbers = 0  # Numbers already in the directory's numbers file
+        self.chunks = []   # Chunk files, oldest first
+        self.saved_rows = 0
+        self.ringing_since = {}  # Ringing phone -> when it started
+        self.talking = {}  # Phone -> open record [start, answer, caller, callee, outcome]
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.chunks = sorted(glob.glob(os.path.join(directory, 'cdr-*.bin')))
+            for chunk in self.chunks:
+                with open(chunk, 'rb') as file:
+                    self.saved_rows += CDR_HEADER.unpack(file.read(CDR_HEADER.size))[1]
+            try:
+                with open(os.path.join(directory, 'numbers.txt')) as file:
+                    for number in file.read().split():
+                        self.ids[number] = len(self.numbers)
+                        self.numbers.append(number)
+            except FileNotFoundError:
+                pass
+            self.saved_numbers = len(self.numbers)
+
+    def __len__(self):
+        return self.saved_rows + len(self.columns['outcome'])
+
+    # Reports from the switch
+
+    def ringing(self, callee):
+        self.ringing_since[callee] = self.clock()
+
+    def answered(self, caller, callee, call_type, other):
+        # callee answered caller; other is who the caller was talking to before
+        now = self.clock()
+        start = self.ringing_since.pop(callee, now)
+        if call_type == TRANSFER:
+            # The caller hands other over to callee, ending the caller's call
+            if self.hangup(caller, CDR_TRANSFERRED):
+                self.hangup(other)
+            else:
+                self.hangup(other, CDR_TRANSFERRED)  # A bridge that fell back to two parties
+            self._open([start, now, other, callee, CDR_COMPLETED], (other, callee))
+        elif call_type == CONFERENCE:
+            self._open([start, now, caller, callee, CDR_CONFERENCED], (callee,))  # Lasts while callee stays
+        else:
+            self._open([start, now, caller, callee, CDR_COMPLETED], (caller, callee))
+
+    def unanswered(self, caller, callee, call_type):
+        now = self.clock()
+        start = self.ringing_since.pop(callee, now)
+        self._append(start, math.nan, now, caller, callee, UNANSWERED_OUTCOMES[call_type])
+
+    def hangup(self, phone, outcome=None):
+        # phone's conversation is over, for it and whoever it was talking to;
+        # returns whether there was one
+        record = self.talking.get(phone)
+        if record is None:
+            return False
+        for party in (record[2], record[3]):
+            if self.talking.get(party) is record:
+                del self.talking[party]
+        self._append(record[0], record[1], self.clock(), record[2], record[3],
+                     record[4] if outcome is None else outcome)
+        return True
+
+    def _open(self, record, parties):
+        for party in parties:
+            self.hangup(party)  # Whatever it was doing before has ended
+            self.talking[party] = record
+
+    def _id(self, phone):
+        found = self.ids.get(phone.number)
+        if found is None:
+            found = self.ids[phone.number] = len(self.numbers)
+            self.numbers.append(phone.number)
+        return found
+
+    def _append(self, start, answer, end, caller, callee, outcome):
+        columns = self.columns
+        columns['start'].append(start)
+        columns['answer'].append(answer)
+        columns['end'].append(end)
+        columns['caller'].append(self._id(caller))
+        columns['callee'].append(self._id(callee))
+        columns['outcome'].append(outcome)
+        columns['hour'].append(int(start // 3600) % 24)
+        if self.directory is not None and len(columns['outcome']) >= self.chunk_rows:
+            self.flush()
+
+    # Storage
+
+    def flush(self):
+        # Write the records held in memory as a new chunk
+        rows = len(self.columns['outcome'])
+        if self.directory is None or not rows:
+            return
+        if len(self.numbers) > self.saved_numbers:
+            # Numbers first, so every id in a chunk on disk can be resolved
+            with open(os.path.join(self.directory, 'numbers.txt'), 'a') as file:
+                file.write(''.join(number + '\n' for number in self.numbers[self.saved_numbers:]))
+            self.saved_numbers = len(self.numbers)
+        counts = self._phone_counts(self.columns)
+        summary = (array.array('I', counts.keys()), array.array('I', counts.values()))
+        path = os.path.join(self.directory, f'cdr-{len(self.chunks):06d}.bin')
+        with open(path, 'wb') as file:
+            file.write(CDR_HEADER.pack(CDR_MAGIC, rows, len(counts)))
+            for column in [self.columns[name] for name, _ in CDR_COLUMNS] + list(summary):
+                if sys.byteorder != 'little':
+                    column = array.array(column.typecode, column)
+                    column.byteswap()
+                column.tofile(file)
+        self.chunks.append(path)
+        self.saved_rows += rows
+        self.columns = {name: array.array(code) for name, code in CDR_COLUMNS}
+
+    def _read_chunk(self, path, names):
+        # The named columns of a chunk file; 'phones' and 'counts' are its summary
+        columns = {}
+        with open(path, 'rb') as file:
+            magic, rows, phones = CDR_HEADER.unpack(file.read(CDR_HEADER.size))
+            if magic != CDR_MAGIC:
+                raise ValueError(f"{path} is not a call record chunk")
+            offset = CDR_HEADER.size
+            for name, code, length in [(name, code, rows) for name, code in CDR_COLUMNS] + \
+                                      [('phones', 'I', phones), ('counts', 'I', phones)]:
+                size = length * array.array(code).itemsize
+                if name in names:
+                    file.seek(offset)
+                    column = array.array(code)
+                    column.frombytes(file.read(size))
+                    if sys.byteorder != 'little':
+                        column.byteswap()
+                    columns[name] = column
+                offset += size
+        return columns
+
+    @staticmethod
+    def _phone_counts(columns):
+        counts = collections.Counter(columns['caller'])
+        counts.update(columns['callee'])
+        return counts
+
+    def scan(self, *names):
+        # Yield {name: column} for each chunk on disk, then the rows in memory
+        for path in self.chunks:
+            yield self._read_chunk(path, names)
+        yield {name: self.columns[name] for name in names}
+
+    # Queries
+
+    def outcome_counts(self):
+        counts = [0] * len(OUTCOME_NAMES)
+        for chunk in self.scan('outcome'):
+            data = chunk['outcome'].tobytes()
+            for code in range(len(OUTCOME_NAMES)):
+                counts[code] += data.count(code)
+        return dict(zip(OUTCOME_NAMES, counts))
+
+    def calls_per_phone(self):
+        # Number -> records it took part in, as caller or callee. Chunks on disk
+        # carry these counts already; only the rows in memory are counted here.
+        counts = self._phone_counts(self.columns)
+        for path in self.chunks:
+            summary = self._read_chunk(path, ('phones', 'counts'))
+            for phone_id, count in zip(summary['phones'], summary['counts']):
+                counts[phone_id] += count
+        return collections.Counter({self.numbers[phone_id]: count for phone_id, count in counts.items()})
+
+    def busy_hours(self):
+        # Calls started in each hour of the day (UTC), hour 0 first
+        counts = [0] * 24
+        for chunk in self.scan('hour'):
+            data = chunk['hour'].tobytes()
+            for hour in range(24):
+                counts[hour] += data.count(hour)
+        return counts
+
+    def average_hold_time(self):
+        # Mean seconds from answer to hang-up over answered calls
+        total = 0.0
+        answered = 0
+        for chunk in self.scan('answer', 'end', 'outcome'):
+            mask = chunk['outcome'].tobytes().translate(ANSWERED)
+            total += math.fsum(map(operator.sub, itertools.compress(chunk['end'], mask),
+                                   itertools.compress(chunk['answer'], mask)))
+            answered += mask.count(1)
+        return total / answered if answered else 0.0
+
+    def failed_transfer_rate(self):
+        counts = self.outcome_counts()
+        attempts = counts['transferred'] + counts['transfer_failed']
+        return counts['transfer_failed'] / attempts if attempts else 0.0
+
+    def report(self):
+        # One-line summary, as the cdr command prints it
+        counts = self.outcome_counts()
+        hours = self.busy_hours()
+        busiest = max(range(24), key=hours.__getitem__)
+        return (f"{len(self)} call records: " + ', '.join(f"{name} {count}" for name, count in counts.items()) +
+                f"; average hold {self.average_hold_time():.1f}s"
+                f"; failed transfers {self.failed_transfer_rate():.1%}"
+                f"; busy hour {busiest:02d}:00 ({hours[busiest]} calls)")
@@ -0,0 +1,134 @@
+import threading
+
+from main import CALL_DEPTH, Command, call_links, parse_command
+
+
+class Serialized:
+    # Stands in for an object shared by every phone (a sink, the timeouts, the call
+    # records) and runs each of its methods under one lock
+    def __init__(self, target, lock=None):
+        self.target = target
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def __getattr__(self, name):
+        value = getattr(self.target, name)
+        if not callable(value):
+            return value
+        lock = self.lock
+
+        def locked(*args):
+            with lock:
+                return value(*args)
+        setattr(self, name, locked)  # Found directly from now on
+        return locked
+
+    def __len__(self):
+        with self.lock:
+            return len(self.target)
+
+
+class ConcurrentSwitch:
+    # Runs console commands on one TelephoneSystem from many threads. A phone
+    # command locks only the phones it can touch: those it names and everything
+    # within CALL_DEPTH call links of them. Locks are always taken in number
+    # order, so commands never wait on each other in a cycle, and commands on
+    # unrelated phones share no lock. Switch commands (status and the rest)
+    # hold every lock. Metrics swap the switch's sink around each command, so
+    # they cannot be used here; the directory must not be replaced meanwhile.
+    def __init__(self, system):
+        if system.metrics is not None:
+            raise ValueError("metrics cannot be collected while commands run concurrently")
+        self.system = system
+        self.locks = {}  # Number -> lock, for every phone a command has locked so far
+        self.table = threading.Lock()  # Held to add locks, and by switch commands throughout
+        system.sink = Serialized(system.sink)
+        if system.timeouts is not None:
+            system.timeouts = Serialized(system.timeouts)
+            system.phones.timers = system.timeouts
+        if system.cdrs is not None:
+            system.cdrs = Serialized(system.cdrs)
+        if system.admission is not None:
+            system.admission = Serialized(system.admission)
+        if system.history is not None:
+            system.history = Serialized(system.history)
+            system.phones.history = system.history
+
+    def run(self, command):
+        # Run one console command, text or parsed, from any thread; False for a blank line
+        if command.__class__ is not Command:
+            command = parse_command(command)
+            if command is None:
+                return False
+        if command.switch is not None:
+            with self.table:
+                held = sorted(self.locks)
+                self._lock(held)
+                try:
+                    self.execute(command)
+                finally:
+                    self._unlock(held)
+            return True
+        named = self.named(command.identifiers) if command.phones else []
+        held = []
+        try:
+            while True:
+                # The phones are only known for sure once their links are locked;
+                # if locking them showed more, start again with the larger set
+                wanted = self.reach(named)
+                if wanted.issubset(held):
+                    break
+                wanted = sorted(wanted.union(held))
+                self._unlock(held)
+                held = []
+                locks = self.locks
+                if not all(number in locks for number in wanted):
+                    with self.table:
+                        for number in wanted:
+                            if number not in locks:
+                                locks[number] = threading.Lock()
+                self._lock(wanted)
+                held = wanted
+            self.execute(command)
+        finally:
+            self._unlock(held)
+        return True
+
+    def named(self, identifiers):
+        # Phones the identifiers can stand for, including every phone a number plan route could pick
+        system = self.system
+        phones = []
+        for identifier in identifiers:
+            phone = system.find_phone(identifier)
+            if phone is not None:
+                phones.append(phone)
+            elif system.plan is not None:
+                phones += system.plan.candidates(system, identifier)
+        return phones
+
+    def execute(self, command):
+        # Called with every phone the command can touch locked
+        command.run(self.system)
+
+    @staticmethod
+    def reach(phones):
+        # Numbers of the phones a command on these phones can touch
+        reached = {phone.number for phone in phones}
+        level = phones
+        for _ in range(CALL_DEPTH):
+            following = [linked for phone in level for linked in call_links(phone)]
+            if not following:
+                break
+            level = []
+            for phone in following:
+                if phone.number not in reached:
+                    reached.add(phone.number)
+                    level.append(phone)
+        return reached
+
+    def _lock(self, numbers):
+        for number in numbers:
+            self.locks[number].acquire()
+
+    def _unlock(self, numbers):
+        for number in numbers:
+            self.locks[number].release()
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+
+from main import (ADMISSION_REPORT, CDR_REPORT, EVENT_TEXT, HISTORY, INTERNAL_COMMANDS, METRICS, PHONE_COMMANDS, SHED,
+                  STATE_COUNTS, STATUS, Command, EventSink, NullSink, parse_command, run_command)
+
+# Journal file: one line per command that changed a phone,
+# "<sequence>\t<command>\t<transitions>", where transitions are the events the
+# command caused, as text joined by " | ".
+# Only whole lines count, so a write torn by a crash is ignored on replay.
+# Reports, and refusals that depend on the time they happened rather than on state,
+# are left out of an entry's transitions
+QUERY_EVENTS = frozenset((STATUS, STATE_COUNTS, METRICS, CDR_REPORT, ADMISSION_REPORT, SHED, HISTORY))
+
+
+class CaptureSink(EventSink):
+    # Forwards events to another sink and keeps the text of the transitions among them
+    def __init__(self, sink):
+        self.sink = sink
+        self.transitions = []
+
+    def emit(self, event, *args):
+        self.sink.emit(event, *args)
+        if event not in QUERY_EVENTS:
+            self.transitions.append(EVENT_TEXT[event](*args))
+
+    def flush(self):
+        self.sink.flush()
+
+
+def last_journal_sequence(filename, tail=1 << 16):
+    # Sequence number of the last whole entry, reading only the end of the file
+    try:
+        with open(filename, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            file.seek(max(0, size - tail))
+            lines = file.read().split(b'\n')[:-1]  # Drop the part after the last newline
+    except FileNotFoundError:
+        return 0
+    for line in reversed(lines):
+        sequence = line.split(b'\t', 1)[0]
+        if sequence.isdigit():
+            return int(sequence)
+    return 0
+
+
+class Journal:
+    # Append-only write-ahead journal with group commit. Entries are buffered and
+    # written with one write and one fsync per group: when group_size entries are
+    # pending or the oldest pending entry is window seconds old, whichever is first.
+    # A flusher thread enforces the window even when no further command arrives.
+    # A crash loses at most the pending group; group_size=1 makes every command durable.
+    def __init__(self, filename, group_size=256, window=0.01, fsync=True):
+        self.sequence = last_journal_sequence(filename)
+        self.file = open(filename, 'ab')
+        self._drop_torn_write()
+        self.group_size = group_size
+        self.window = window
+        self.fsync = fsync
+        self.pending = []
+        self.oldest = 0.0  # When the first pending entry was added
+        self.commits = 0
+        self.capture = CaptureSink(None)  # Reused for every command
+        self.lock = threading.Condition()  # Guards pending and the file; wakes the flusher
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_on_deadline, daemon=True)
+        self.flusher.start()
+
+    def _drop_torn_write(self, tail=1 << 16):
+        # Cut off a partial last line left by a crash, so the next entry starts on a line of its own
+        size = self.file.seek(0, os.SEEK_END)
+        with open(self.file.name, 'rb') as file:
+            file.seek(max(0, size - tail))
+            data = file.read()
+        if data and not data.endswith(b'\n'):
+            cut = data.rfind(b'\n')
+            if cut >= 0 or size <= tail:
+                self.file.truncate(size - len(data) + cut + 1)
+
+    def run(self, system, command):
+        # Apply a command like run_command and journal it if it changed any phone
+        capture = self.capture
+        capture.sink = system.sink
+        system.sink = capture
+        changes = system.phones.changes
+        try:
+            ran = run_command(system, command)
+        finally:
+            system.sink = capture.sink
+        if system.phones.changes != changes:
+            words = command.words if command.__class__ is Command else command.split()
+            self.append(' '.join(words), capture.transitions)
+            system.journal_sequence = self.sequence
+        capture.transitions = []
+        return ran
+
+    def append(self, command, transitions):
+        with self.lock:
+            self.sequence += 1
+            now = time.monotonic()
+            if not self.pending:
+                self.oldest = now
+                self.lock.notify()  # The flusher now has a deadline to wait for
+            self.pending.append(f"{self.sequence}\t{command}\t{' | '.join(transitions)}\n")
+            if len(self.pending) >= self.group_size or now - self.oldest >= self.window:
+                self._commit()
+
+    def _flush_on_deadline(self):
+        with self.lock:
+            while not self.closed:
+                if not self.pending:
+                    self.lock.wait()
+                    continue
+                remaining = self.oldest + self.window - time.monotonic()
+                if remaining > 0:
+                    self.lock.wait(remaining)
+                else:
+                    self._commit()
+
+    def commit(self):
+        # Write and sync everything pending as one group
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        if not self.pending:
+            return
+        self.file.write(''.join(self.pending).encode('utf-8'))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.pending.clear()
+        self.commits += 1
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self._commit()
+            self.lock.notify()
+        self.flusher.join()
+        self.file.close()
+
+
+def read_journal(filename, after=0):
+    # Yield (sequence, command, transitions) for each whole entry after sequence `after`
+    with open(filename, 'rb') as file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                break  # Torn final write
+            sequence, command, transitions = line[:-1].decode('utf-8').split('\t', 2)
+            sequence = int(sequence)
+            if sequence > after:
+                yield sequence, command, transitions
+
+
+def replay_journal(system, filename, verify=False):
+    # Rebuild state by re-running the journal entries newer than the system's state,
+    # with output suppressed. Returns (entries replayed, sequences whose transitions
+    # differ from the journal); the comparison is only made when verify is set.
+    previous = system.sink
+    capture = CaptureSink(NullSink()) if verify else None
+    system.sink = capture or NullSink()
+    count = 0
+    mismatches = []
+    verbs = {**PHONE_COMMANDS, **INTERNAL_COMMANDS}  # What internal_command parses with, built once
+    try:
+        for sequence, command, transitions in read_journal(filename, system.journal_sequence):
+            run_command(system, parse_command(command, verbs))
+            if capture:
+                if ' | '.join(capture.transitions) != transitions:
+                    mismatches.append(sequence)
+                capture.transitions.clear()
+            system.journal_sequence = sequence
+            count += 1
+    finally:
+        system.sink = previous
+    return count, mismatches
@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import random
+import time
+
+from main import NullSink, TelephoneSystem
+
+
+def call_script(rng, numbers):
+    # One simple call: pick up, dial, answer, both hang up
+    a, b = rng.sample(numbers, 2)
+    return [f"{a} offhook", f"{a} call {b}", f"{b} offhook", f"{a} onhook", f"{b} onhook"]
+
+
+async def run_client(host, port, numbers, commands, rng, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        sent = 0
+        while sent < commands:
+            for command in call_script(rng, numbers):
+                if sent == commands:
+                    break
+                start = time.perf_counter()
+                writer.write(command.encode('utf-8') + b"\n")
+                await writer.drain()
+                while await reader.readline() not in (b"\n", b""):
+                    pass  # Skip response lines up to the blank end-of-response line
+                latencies.append(time.perf_counter() - start)
+                sent += 1
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def generate(host, port, numbers, clients, commands, seed):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, numbers, commands, random.Random(seed + i), latencies)
+                           for i in range(clients)))
+    return latencies, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the telephone switch server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4230)
+    parser.add_argument('--phones', default='phones.txt', help="directory to draw phone numbers from")
+    parser.add_argument('--clients', type=int, default=100, help="concurrent connections")
+    parser.add_argument('--commands', type=int, default=1000, help="commands sent by each connection")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    directory = TelephoneSystem(sink=NullSink())
+    directory.load_phones_bulk(args.phones)
+    numbers = list(directory.phones)
+    if len(numbers) < 2:
+        parser.error("the directory needs at least two phones")
+
+    latencies, elapsed = asyncio.run(generate(args.host, args.port, numbers,
+                                              args.clients, args.commands, args.seed))
+    latencies.sort()
+    rate = len(latencies) / elapsed if elapsed > 0 else 0.0
+    print(f"{len(latencies)} commands over {args.clients} connections in {elapsed:.3f}s ({rate:.0f} commands/sec)")
+    print("latency ms: " + ", ".join(f"p{round(f * 100)}={percentile(latencies, f) * 1000:.2f}"
+                                     for f in (0.5, 0.9, 0.99)) +
+          f", max={latencies[-1] * 1000 if latencies else 0.0:.2f}")
+
+
+if __name__ == "__main__":
+    main()
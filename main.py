@@ -1,17 +1,182 @@
+import argparse
+import array
+import bisect
+import os
+import struct
+import sys
+import time
+
+# Events reported by TelephoneSystem. Each is emitted with the raw values
+# (usually phone names) so sinks only pay for formatting if they want text.
+HEARS = 'hears'                            # name, tone
+TALKING = 'talking'                        # name, name
+CONFERENCE_TALKING = 'conference_talking'  # list of names
+ALREADY_OFFHOOK = 'already_offhook'        # name
+ALREADY_ONHOOK = 'already_onhook'          # name
+NOW_ONHOOK = 'now_onhook'                  # name
+NOT_RINGING = 'not_ringing'                # name
+LEFT_CONFERENCE = 'left_conference'        # name
+NO_ANSWER = 'no_answer'                    # name of the phone that rang out
+DIALTONE_TIMEOUT = 'dialtone_timeout'      # name
+TRANSFER_FAILED = 'transfer_failed'        # name of the phone that did not answer
+CONFERENCE_FAILED = 'conference_failed'
+NOT_FOUND = 'not_found'                    # identifier
+CALLER_NOT_FOUND = 'caller_not_found'      # identifier
+NO_CALLER = 'no_caller'
+STATUS = 'status'                          # number, status line (formatted when emitted)
+INVALID_ENTRY = 'invalid_entry'            # directory line
+AMBIGUOUS_NAME = 'ambiguous_name'          # name, list of numbers
+LOAD_REJECTS = 'load_rejects'              # list of (line number, line) pairs
+LOADED = 'loaded'                          # phone count, seconds
+STATE_COUNTS = 'state_counts'              # {state name: phones in that state}
+METRICS = 'metrics'                        # Metrics, or None when they are off
+CDR_REPORT = 'cdr_report'                  # CallRecords, or None when they are off
+SHED = 'shed'                              # name of the phone whose call setup was refused
+ADMISSION_REPORT = 'admission_report'      # AdmissionControl, or None when it is off
+HISTORY = 'history'                        # phone, its recent state changes (None when history is off)
+INVALID_COMMAND = 'invalid_command'
+
+# Console text for each event, exactly as the switch has always printed it
+EVENT_TEXT = {
+    HEARS: lambda name, tone: f"{name} hears {tone}.",
+    TALKING: lambda name1, name2: f"{name1} and {name2} are talking.",
+    CONFERENCE_TALKING: lambda names: f"{', '.join(names)} are talking.",
+    ALREADY_OFFHOOK: lambda name: f"{name} is already offhook.",
+    ALREADY_ONHOOK: lambda name: f"{name} is already onhook.",
+    NOW_ONHOOK: lambda name: f"{name} is now onhook.",
+    NOT_RINGING: lambda name: f"{name} is not ringing.",
+    LEFT_CONFERENCE: lambda name: f"{name} hangs up from conference.",
+    NO_ANSWER: lambda name: f"{name} did not answer.",
+    DIALTONE_TIMEOUT: lambda name: f"{name}'s dialtone timed out.",
+    TRANSFER_FAILED: lambda name: f"Transfer to {name} failed.",
+    CONFERENCE_FAILED: lambda: "Conference call failed.",
+    NOT_FOUND: lambda identifier: f"Phone {identifier} not found.",
+    CALLER_NOT_FOUND: lambda identifier: f"Caller {identifier} not found.",
+    NO_CALLER: lambda: "Error: No caller information.",
+    STATUS: lambda number, line: line,
+    INVALID_ENTRY: lambda line: f"Ignored invalid entry: {line}",
+    AMBIGUOUS_NAME: lambda name, numbers: f"Ambiguous name {name}: {', '.join(numbers)} (using {numbers[0]}).",
+    LOAD_REJECTS: lambda rejects: reject_report(rejects),
+    LOADED: lambda count, elapsed: f"Loaded {count} phones in {elapsed:.3f}s ({count / elapsed if elapsed > 0 else 0:.0f} phones/sec).",
+    INVALID_COMMAND: lambda: "Invalid command.",
+    STATE_COUNTS: lambda counts: ', '.join(f"{name}: {count}" for name, count in counts.items()),
+    METRICS: lambda metrics: metrics.export().rstrip("\n") if metrics is not None else "Metrics are off.",
+    CDR_REPORT: lambda records: records.report() if records is not None else "Call records are off.",
+    SHED: lambda name: f"{name} hears congestion.",
+    HISTORY: lambda phone, entries: history_report(phone, entries),
+    ADMISSION_REPORT: lambda control: admission_report(control) if control is not None else "Admission control is off.",
+}
+
+REJECTS_SHOWN = 20  # Rejected lines listed individually before the report is cut short
+
+def reject_report(rejects):
+    lines = [f"Ignored {len(rejects)} invalid entries:"]
+    lines += [f"  line {lineno}: {text}" for lineno, text in rejects[:REJECTS_SHOWN]]
+    if len(rejects) > REJECTS_SHOWN:
+        lines.append(f"  ... and {len(rejects) - REJECTS_SHOWN} more")
+    return "\n".join(lines)
+
+class EventSink:
+    # Receives every event the switch reports; subclasses decide what to do with them
+    def emit(self, event, *args):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+class NullSink(EventSink):
+    # Drops every event, for benchmarking the switch without output cost
+    def emit(self, event, *args):
+        pass
+
+class ListSink(EventSink):
+    # Keeps (event, args) tuples so embedding code can consume results in batches
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event, *args):
+        self.events.append((event, args))
+
+    def drain(self):
+        events, self.events = self.events, []
+        return events
+
+class TextSink(EventSink):
+    # Renders events as console text. With buffer_size > 0, lines are collected
+    # and written in chunks of about that many characters instead of one at a time.
+    def __init__(self, stream=None, buffer_size=0):
+        self.stream = stream  # None means whatever sys.stdout is at write time
+        self.buffer_size = buffer_size
+        self.lines = []
+        self.size = 0
+
+    def _write(self, text):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(text)
+
+    def emit(self, event, *args):
+        line = EVENT_TEXT[event](*args)
+        if self.buffer_size <= 0:
+            self._write(line + "\n")
+            return
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self._write("\n".join(self.lines))
+            self.lines.clear()
+            self.size = 0
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.flush()
+
+# Phone states, stored as small integer codes
+ONHOOK, OFFHOOK, RINGING, DIALING, CALLING, CONNECTED = range(6)
+STATE_NAMES = ('onhook', 'offhook', 'ringing', 'dialing', 'calling', 'connected')
+STATE_CODES = {name: code for code, name in enumerate(STATE_NAMES)}
+OFFHOOK_STATES = frozenset((OFFHOOK, DIALING, CALLING, CONNECTED))  # Handset is up
+BUSY_STATES = OFFHOOK_STATES | {RINGING}  # Cannot accept a new call
+
+# Call types, for what a 'calling' phone is trying to set up
+NORMAL, TRANSFER, CONFERENCE = range(3)
+CALL_TYPE_NAMES = ('normal', 'transfer', 'conference')
+CALL_TYPE_CODES = {name: code for code, name in enumerate(CALL_TYPE_NAMES)}
+
 class Phone:
+    # Slotted so large directories carry no per-phone __dict__
+    __slots__ = ('number', 'name', 'state_code', 'current_call', 'ringing_from', 'call_type_code')
+
     def __init__(self, number, name):
         self.number = number  # Phone number (string)
         self.name = name      # Phone owner's name (string)
-        self.state = 'onhook'  # Phone state: 'onhook', 'offhook', 'ringing', 'dialing', 'calling', 'connected'
+        self.state_code = ONHOOK  # Phone state, one of ONHOOK, OFFHOOK, RINGING, DIALING, CALLING, CONNECTED
         self.current_call = None  # Holds the current call participants
         self.ringing_from = None  # Who is calling this phone
-        self.call_type = 'normal'
+        self.call_type_code = NORMAL
+
+    # The string forms are kept for display and for callers that predate the codes.
+    # The state name is read-only: states change through PhoneDirectory.set_state,
+    # which keeps the directory's per-state sets in step.
+    @property
+    def state(self):
+        return STATE_NAMES[self.state_code]
+
+    @property
+    def call_type(self):
+        return CALL_TYPE_NAMES[self.call_type_code]
+
+    @call_type.setter
+    def call_type(self, name):
+        self.call_type_code = CALL_TYPE_CODES[name]
 
     def __str__(self):
         # Return a string representation of the phone's status
-        status = f"{self.name} ({self.number}): {self.state}"
+        status = f"{self.name} ({self.number}): {STATE_NAMES[self.state_code]}"
         if self.current_call:
-            if isinstance(self.current_call, list):
+            if isinstance(self.current_call, Conference):
                 # In a conference call
                 others = ', '.join(p.name for p in self.current_call if p != self)
                 status += f" (talking to {others})"
@@ -20,9 +185,617 @@ class Phone:
                 status += f" (talking to {self.current_call.name})"
         return status
 
-class TelephoneSystem:
+# Snapshot file layout: header, then the phone strings, then one fixed-size record
+# per phone, then the conference participant lists. Phone references are indexes
+# into the phone list; a conference list shared by several phones is stored once.
+SNAPSHOT_MAGIC = b'TSNAP\x00\x00\x02'
+SNAPSHOT_HEADER = struct.Struct('<8sIIIIQ')  # magic, phones, conferences, strings bytes, conference bytes,
+                                             # last journal sequence the snapshot includes
+SNAPSHOT_MAGIC_V1 = b'TSNAP\x00\x00\x01'   # Same layout without the journal sequence
+SNAPSHOT_HEADER_V1 = struct.Struct('<8sIIII')
+SNAPSHOT_RECORD = struct.Struct('<BBBii')   # state, call type, call kind, call ref, ringing_from ref
+CALL_NONE, CALL_PHONE, CALL_CONFERENCE = range(3)  # What a record's call ref points at
+
+class Conference:
+    # A conference bridge, shared by reference through each participant's current_call.
+    # Membership is an insertion-ordered dict, so join, leave and len are O(1) and
+    # participants are listed in the order they joined. A phone being invited is
+    # pending until it answers: it holds a place against the size limit but is not
+    # a participant, so nobody on the bridge is talking to it yet.
+    __slots__ = ('members', 'pending')
+
+    def __init__(self, phones=()):
+        self.members = dict.fromkeys(phones)
+        self.pending = {}  # Invited phone -> the participant inviting it
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __contains__(self, phone):
+        return phone in self.members
+
+    def join(self, phone):
+        self.pending.pop(phone, None)
+        self.members[phone] = None
+
+    def leave(self, phone):
+        self.members.pop(phone, None)
+
+    def invite(self, phone, inviter):
+        self.pending[phone] = inviter
+
+    def withdraw(self, phone):
+        self.pending.pop(phone, None)
+
+    def invited_by(self, inviter):
+        return [phone for phone, by in self.pending.items() if by is inviter]
+
+
+def restore_invites(phones):
+    # Rebuild the pending invitations of bridges from phone state, for code that
+    # assigned call state directly (restores, shard transfers)
+    for phone in phones:
+        inviter = phone.ringing_from
+        if phone.state_code == RINGING and inviter is not None and inviter.state_code == CALLING \
+                and inviter.call_type_code == CONFERENCE and isinstance(inviter.current_call, Conference):
+            inviter.current_call.invite(phone, inviter)
+
+class PhoneDirectory(dict):
+    # Phones keyed by number, with a name index kept in step with every add and remove
+    def __init__(self, phones=None):
+        super().__init__()
+        self.names = {}  # name -> list of phones with that name, in insertion order
+        self.states = [set() for _ in STATE_NAMES]  # Phones currently in each state, by state code
+        self.changed = set()  # Phones whose status line may have changed since last taken
+        self._sorted = None  # Numbers in sorted order, built on demand for prefix queries
+        self.timers = None  # Timeouts told about every transition, if the switch has them
+        self.history = None  # PhoneHistory recording every transition, if the switch keeps one
+        self.generation = 0  # Bumped whenever a phone is added or removed
+        self.changes = 0  # Bumped by every transition and call change, so callers can tell a command did something
+        if phones:
+            self.update(phones)
+
+    def _index(self, phone):
+        self.names.setdefault(phone.name, []).append(phone)
+        self.states[phone.state_code].add(phone)
+        self.changed.add(phone)
+        self._sorted = None
+        self.generation += 1
+
+    def _unindex(self, phone):
+        holders = self.names.get(phone.name)
+        if holders and phone in holders:
+            holders.remove(phone)
+            if not holders:
+                del self.names[phone.name]
+        self.states[phone.state_code].discard(phone)
+        self.changed.discard(phone)
+        self._sorted = None
+        self.generation += 1
+
+    def __setitem__(self, number, phone):
+        old = dict.get(self, number)
+        if old is not None:
+            self._unindex(old)
+        super().__setitem__(number, phone)
+        self._index(phone)
+
+    def __delitem__(self, number):
+        phone = self[number]
+        super().__delitem__(number)
+        self._unindex(phone)
+
+    def pop(self, number, *default):
+        if number in self:
+            phone = self[number]
+            del self[number]
+            return phone
+        return super().pop(number, *default)
+
+    def popitem(self):
+        number, phone = super().popitem()
+        self._unindex(phone)
+        return number, phone
+
+    def setdefault(self, number, phone=None):
+        if number not in self:
+            self[number] = phone
+        return self[number]
+
+    def update(self, *args, **kwargs):
+        for number, phone in dict(*args, **kwargs).items():
+            self[number] = phone
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def copy(self):
+        # dict.copy would hand back a plain dict with no indexes
+        return PhoneDirectory(self)
+
+    def clear(self):
+        super().clear()
+        self.names.clear()
+        for members in self.states:
+            members.clear()
+        self.changed.clear()
+        self._sorted = None
+        self.generation += 1
+
+    def set_state(self, phone, code):
+        # Every state transition goes through here so the per-state sets stay exact
+        history = self.history
+        if history is not None and phone.state_code != code:
+            history.record(phone, phone.state_code, code)
+        self.states[phone.state_code].discard(phone)
+        phone.state_code = code
+        self.states[code].add(phone)
+        self.changed.add(phone)
+        self.changes += 1
+        timers = self.timers
+        if timers is not None:
+            timers.transition(phone, code)
+
+    def touch(self, phone):
+        # Record a change to a phone's call (or a whole bridge) that did not change its state
+        self.changed.add(phone)
+        self.changes += 1
+
+    def refile(self, phone, changed=True):
+        # For code that assigned state_code directly (restores, replays): file it
+        # again, and count it as changed unless the caller knows better
+        for members in self.states:
+            members.discard(phone)
+        self.states[phone.state_code].add(phone)
+        if changed:
+            self.changed.add(phone)
+
+    def count(self, code):
+        return len(self.states[code])
+
+    def in_state(self, code):
+        # Phones currently in a state, in number order
+        return sorted(self.states[code], key=lambda p: p.number)
+
+    def with_prefix(self, prefix):
+        # Phones whose number starts with prefix, in number order
+        if self._sorted is None:
+            self._sorted = sorted(self)
+        numbers = self._sorted
+        start = bisect.bisect_left(numbers, prefix)
+        end = start
+        while end < len(numbers) and numbers[end].startswith(prefix):
+            end += 1
+        return [self[number] for number in numbers[start:end]]
+
+    def take_changed(self):
+        # Phones changed since the last call, in number order; a changed conference
+        # bridge stands for all of its participants
+        changed = set()
+        for item in self.changed:
+            if isinstance(item, Conference):
+                changed.update(item)
+            else:
+                changed.add(item)
+        self.changed = set()
+        return sorted(changed, key=lambda p: p.number)
+
+    def by_name(self, name):
+        # First phone registered under this name, matching the old linear scan
+        holders = self.names.get(name)
+        return holders[0] if holders else None
+
+    def duplicate_names(self):
+        # Names shared by more than one phone, mapped to their numbers
+        return {name: [p.number for p in holders] for name, holders in self.names.items() if len(holders) > 1}
+
+# A command reads and writes its named phones, the phones they link to, and the
+# phones those link to (a ringing phone's caller and the caller's other party or
+# conference members), never anything further away.
+CALL_DEPTH = 2
+
+
+def call_links(phone):
+    # Phones a command may follow from this one
+    call = phone.current_call
+    links = list(call) + list(call.pending) if isinstance(call, Conference) else [call] if call is not None else []
+    if phone.ringing_from is not None and phone.state_code == RINGING:
+        links = links + [phone.ringing_from]
+    return links
+
+class HuntGroup:
+    # Phones answering for a number plan route; a call rings the first idle member
+    __slots__ = ('name', 'members')
+
+    def __init__(self, name, members):
+        self.name = name
+        self.members = list(members)  # Identifiers, looked up at call time
+
+    def phones(self, system):
+        found = (system.find_phone(identifier) for identifier in self.members)
+        return [phone for phone in found if phone is not None]
+
+    def pick(self, system):
+        # First on-hook member; if every member is busy, the first one, who is then heard busy
+        phones = self.phones(system)
+        for phone in phones:
+            if phone.state_code == ONHOOK:
+                return phone
+        return phones[0] if phones else None
+
+
+DIGITS = '0123456789'
+
+
+def range_patterns(low, high):
+    # low..high, digit strings of one length, as patterns: one entry per digit
+    # holding the digits allowed there, or None for any digit
+    if not low:
+        return [[]]
+    rest = len(low) - 1
+    if low[0] == high[0]:
+        return [[low[0]] + pattern for pattern in range_patterns(low[1:], high[1:])]
+    if low[1:] == '0' * rest and high[1:] == '9' * rest:
+        return [[None if (low[0], high[0]) == ('0', '9') else DIGITS[int(low[0]):int(high[0]) + 1]] + [None] * rest]
+    patterns = range_patterns(low, low[0] + '9' * rest)
+    if int(high[0]) - int(low[0]) > 1:
+        patterns.append([DIGITS[int(low[0]) + 1:int(high[0])]] + [None] * rest)
+    return patterns + range_patterns(high[0] + '0' * rest, high)
+
+
+class NumberPlan:
+    # Routes for dialled numbers that are not phones in the directory. Patterns are
+    # digits, x for any digit, or a range such as 40000-40999, and go into a digit
+    # trie. Where patterns overlap, an exact digit beats x at each position from
+    # the left. Before the first lookup the trie is compiled so that every digit
+    # has exactly one place to go, so a lookup costs one step per digit however
+    # many routes there are. A route leads to a HuntGroup or to one phone; group
+    # names are resolved when the trie is compiled, so a route may come before its
+    # group.
+    def __init__(self):
+        self.root = {}    # Digit or 'x' -> child node; a complete pattern's node holds its target under ''
+        self.groups = {}  # Name -> HuntGroup
+        self.routes = 0
+        self.compiled = None  # Digit -> child node, built from root when first needed
+
+    def add_group(self, name, members):
+        self.groups[name] = HuntGroup(name, members)
+        self.compiled = None
+        return self.groups[name]
+
+    def add_route(self, pattern, target):
+        # target: a hunt group's name, else a phone's number or name
+        low, _, high = pattern.lower().partition('-')
+        if high:
+            if not (low.isdigit() and high.isdigit() and len(low) == len(high) and low <= high):
+                raise ValueError(f"bad number range {pattern}")
+            patterns = range_patterns(low, high)
+        elif low and all(c in DIGITS or c == 'x' for c in low):
+            patterns = [[None if c == 'x' else c for c in low]]
+        else:
+            raise ValueError(f"bad number pattern {pattern}")
+        for digits in patterns:
+            nodes = [self.root]
+            for allowed in digits:
+                nodes = [node.setdefault(key, {}) for node in nodes for key in (allowed or 'x')]
+            for node in nodes:
+                node[''] = target
+        self.routes += 1
+        self.compiled = None
+
+    def _compile(self, choices, built):
+        # One node standing for several trie nodes, tried in order: each digit leads
+        # to that digit's children, then the x children, of the first choice, then
+        # of the next; the target is the first choice's that has one
+        key = tuple(map(id, choices))
+        node = built.get(key)
+        if node is not None:
+            return node
+        node = built[key] = {}
+        for choice in choices:
+            if '' in choice:
+                node[''] = self.groups.get(choice[''], choice[''])
+                break
+        for digit in DIGITS:
+            following = [child for choice in choices for child in (choice.get(digit), choice.get('x')) if child]
+            if following:
+                node[digit] = self._compile(following, built)
+        return node
+
+    def target(self, number):
+        # What number routes to, or None
+        if number.__class__ is not str or not number.isdigit():
+            return None
+        node = self.compiled
+        if node is None:
+            node = self.compiled = self._compile([self.root], {})
+        for digit in number:
+            node = node.get(digit)
+            if node is None:
+                return None
+        return node.get('')
+
+    def route(self, system, number):
+        # The phone a call to number should ring, or None
+        target = self.target(number)
+        if target is None:
+            return None
+        if target.__class__ is HuntGroup:
+            return target.pick(system)
+        return system.find_phone(target)
+
+    def candidates(self, system, number):
+        # Every phone route() could choose for number
+        target = self.target(number)
+        if target is None:
+            return []
+        if target.__class__ is HuntGroup:
+            return target.phones(system)
+        phone = system.find_phone(target)
+        return [phone] if phone is not None else []
+
+    def load(self, filename):
+        # Plan file lines: "group <name> <member>..." or "<pattern> <target>";
+        # blank lines and # comments are skipped
+        with open(filename) as file:
+            for lineno, line in enumerate(file, 1):
+                words = line.split('#', 1)[0].split()
+                if not words:
+                    continue
+                try:
+                    if words[0] == 'group' and len(words) >= 3:
+                        self.add_group(words[1], words[2:])
+                    elif len(words) == 2:
+                        self.add_route(words[0], words[1])
+                    else:
+                        raise ValueError("expected '<pattern> <target>' or 'group <name> <member>...'")
+                except ValueError as error:
+                    raise ValueError(f"{filename}:{lineno}: {error}") from None
+
+HISTORY_DEPTH = 16  # State changes kept for each phone unless told otherwise
+
+
+class PhoneHistory:
+    # The last `depth` state changes of each phone: when, from which state to which,
+    # and the phone's call type. The entries of all phones share two flat arrays,
+    # depth entries per phone, preallocated a block of phones at a time and
+    # overwritten round-robin, so memory is bounded by the number of phones that
+    # have changed state and recording a change is two array stores.
+    def __init__(self, depth=HISTORY_DEPTH, clock=time.time, block=1024):
+        self.depth = depth
+        self.clock = clock
+        self.block = block
+        self.slots = {}  # Number -> slot
+        self.counts = array.array('I')  # Slot -> changes recorded so far
+        self.times = array.array('d')   # Entry (slot * depth + position) -> clock time
+        self.codes = array.array('H')   # Entry -> state before | state after << 4 | call type << 8
+
+    def _allocate(self, number):
+        slot = self.slots[number] = len(self.slots)
+        if slot == len(self.counts):
+            self.counts.frombytes(bytes(self.block * self.counts.itemsize))
+            self.times.frombytes(bytes(self.block * self.depth * self.times.itemsize))
+            self.codes.frombytes(bytes(self.block * self.depth * self.codes.itemsize))
+        return slot
+
+    def record(self, phone, before, after):
+        slot = self.slots.get(phone.number)
+        if slot is None:
+            slot = self._allocate(phone.number)
+        counts = self.counts
+        count = counts[slot]
+        counts[slot] = count + 1
+        entry = slot * self.depth + count % self.depth
+        self.times[entry] = self.clock()
+        self.codes[entry] = before | after << 4 | phone.call_type_code << 8
+
+    def last(self, number, count=None):
+        # Up to count of the phone's latest changes, oldest first, as
+        # (time, state code before, state code after, call type code)
+        slot = self.slots.get(number)
+        if slot is None:
+            return []
+        recorded = self.counts[slot]
+        kept = min(recorded, self.depth) if count is None else min(recorded, self.depth, count)
+        base = slot * self.depth
+        entries = []
+        for n in range(recorded - kept, recorded):
+            entry = base + n % self.depth
+            code = self.codes[entry]
+            entries.append((self.times[entry], code & 15, code >> 4 & 15, code >> 8))
+        return entries
+
+
+def history_report(phone, entries):
+    if entries is None:
+        return "History is off."
+    lines = [f"History of {phone.name} ({phone.number}):"]
+    for stamp, before, after, call_type in entries:
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)) + f".{int(stamp * 1000) % 1000:03d}"
+        kind = f" ({CALL_TYPE_NAMES[call_type]})" if call_type != NORMAL else ''
+        lines.append(f"  {when} {STATE_NAMES[before]} -> {STATE_NAMES[after]}{kind}")
+    if not entries:
+        lines.append("  no state changes recorded")
+    return "\n".join(lines)
+
+# Upper bounds of the latency histogram buckets, in microseconds; one more bucket
+# holds everything slower
+LATENCY_BUCKETS_US = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+LATENCY_BUCKETS_NS = tuple(bound * 1000 for bound in LATENCY_BUCKETS_US)
+INSTRUMENTED = ('pickup', 'onhook', 'call', 'transfer', 'conference', 'timeout')  # Console entry points
+
+class OutcomeSink(EventSink):
+    # Counts what one command's events say happened, then passes them on. The
+    # outcome of a tone is the tone (busy, denial, ringback, ...), otherwise the event.
+    def __init__(self, outcomes, command):
+        self.outcomes = outcomes
+        self.command = command
+        self.sink = None  # The switch's own sink while the command runs
+
+    def emit(self, event, *args):
+        key = (self.command, args[1] if event == HEARS else event)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+        self.sink.emit(event, *args)
+
+    def flush(self):
+        self.sink.flush()
+
+
+class Metrics:
+    # Outcome counters and latency histograms for the INSTRUMENTED methods of a switch.
+    # attach() shadows those methods with timed wrappers on the instance and detach()
+    # removes them again, so a switch without metrics runs the plain methods.
     def __init__(self):
+        self.outcomes = {}  # (command, outcome) -> count
+        self.latency = {}   # command -> [count per bucket..., commands, total ns]
+
+    def attach(self, system):
+        for name in INSTRUMENTED:
+            setattr(system, name, self._timed(system, name, getattr(type(system), name)))
+
+    def detach(self, system):
+        for name in INSTRUMENTED:
+            vars(system).pop(name, None)
+
+    def _timed(self, system, name, method):
+        sink = OutcomeSink(self.outcomes, name)
+        histogram = self.latency.setdefault(name, [0] * (len(LATENCY_BUCKETS_NS) + 3))
+        slowest = len(LATENCY_BUCKETS_NS)
+        clock = time.perf_counter_ns
+        bucket = bisect.bisect_left
+
+        def timed(*args):
+            sink.sink = system.sink
+            system.sink = sink
+            start = clock()
+            try:
+                return method(system, *args)
+            finally:
+                elapsed = clock() - start
+                system.sink = sink.sink
+                histogram[bucket(LATENCY_BUCKETS_NS, elapsed)] += 1
+                histogram[slowest + 1] += 1
+                histogram[slowest + 2] += elapsed
+        return timed
+
+    def snapshot(self):
+        # Plain-data copy: {'outcomes': {(command, outcome): n},
+        # 'latency': {command: {'buckets': [...], 'count': n, 'total_us': us}}}
+        slowest = len(LATENCY_BUCKETS_NS)
+        return {
+            'outcomes': dict(self.outcomes),
+            'latency': {name: {'buckets': h[:slowest + 1], 'count': h[slowest + 1], 'total_us': h[slowest + 2] / 1000}
+                        for name, h in self.latency.items() if h[slowest + 1]},
+        }
+
+    def export(self):
+        # Prometheus-style text: one "name{labels} value" line per sample, buckets cumulative
+        data = self.snapshot()
+        lines = ["# TYPE switch_outcomes_total counter"]
+        for (command, outcome), count in sorted(data['outcomes'].items()):
+            lines.append(f'switch_outcomes_total{{command="{command}",outcome="{outcome}"}} {count}')
+        lines.append("# TYPE switch_latency_us histogram")
+        for command, histogram in sorted(data['latency'].items()):
+            running = 0
+            for bound, count in zip(LATENCY_BUCKETS_US + ('+Inf',), histogram['buckets']):
+                running += count
+                lines.append(f'switch_latency_us_bucket{{command="{command}",le="{bound}"}} {running}')
+            lines.append(f'switch_latency_us_sum{{command="{command}"}} {histogram["total_us"]:.3f}')
+            lines.append(f'switch_latency_us_count{{command="{command}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+SETUP_COMMANDS = ('call', 'transfer', 'conference')  # What admission control limits
+
+
+class AdmissionControl:
+    # Token buckets limiting call setups (call, transfer, conference): one for the
+    # whole switch and one for each originating phone, each refilled at its rate
+    # per second up to its burst. A setup goes ahead only when every bucket that
+    # is configured has a token; a refused one takes none. Only setups that would
+    # otherwise go ahead are checked, so attempts that fail anyway (caller not
+    # offhook, target busy) take no token. Answers and hang-ups are never limited.
+    def __init__(self, rate=None, burst=None, phone_rate=None, phone_burst=None, clock=time.monotonic):
+        self.rate = rate  # Setups per second for the switch, or None for no limit
+        self.burst = burst if burst is not None else max(1, rate or 0)
+        self.phone_rate = phone_rate  # Setups per second for each phone, or None for no limit
+        self.phone_burst = phone_burst if phone_burst is not None else max(1, phone_rate or 0)
+        self.clock = clock
+        self.tokens = self.burst
+        self.stamp = clock()
+        self.buckets = {}  # Number -> [tokens, last refill] for phones that have set up calls
+        self.admitted = dict.fromkeys(SETUP_COMMANDS, 0)
+        self.shed = {(command, limit): 0 for command in SETUP_COMMANDS for limit in ('phone', 'switch')}
+
+    def admit(self, phone, command):
+        # Whether phone may set up a call now; a refusal is counted against the limit that refused it
+        now = self.clock()
+        bucket = None
+        if self.phone_rate is not None:
+            bucket = self.buckets.get(phone.number)
+            if bucket is None:
+                bucket = self.buckets[phone.number] = [self.phone_burst, now]
+            else:
+                bucket[0] = min(self.phone_burst, bucket[0] + (now - bucket[1]) * self.phone_rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                self.shed[command, 'phone'] += 1
+                return False
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < 1:
+                self.shed[command, 'switch'] += 1
+                return False
+            self.tokens -= 1
+        if bucket is not None:
+            bucket[0] -= 1
+        self.admitted[command] += 1
+        return True
+
+    def counts(self):
+        # {'admitted': {command: n}, 'shed': {(command, 'phone' or 'switch'): n}}
+        return {'admitted': dict(self.admitted), 'shed': dict(self.shed)}
+
+
+def admission_report(control):
+    counts = control.counts()
+    shed = counts['shed']
+    return '\n'.join(f"{command}: {counts['admitted'][command]} admitted, "
+                     f"{shed[command, 'phone']} shed by phone limit, {shed[command, 'switch']} by switch limit"
+                     for command in SETUP_COMMANDS)
+
+class TelephoneSystem:
+    def __init__(self, sink=None, conference_limit=3, timeouts=None):
+        self.timeouts = timeouts  # Timeouts for ringing and dialtone, or None for none
+        self.history = None  # PhoneHistory of recent state changes, or None to keep none
         self.phones = {}  # Dictionary to store phones by their number
+        self.sink = sink if sink is not None else TextSink()  # Where events are reported
+        self.conference_limit = conference_limit  # Most parties on one conference bridge
+        self.journal_sequence = 0  # Last journal entry applied to this state
+        self.metrics = None  # Metrics while they are enabled
+        self.cdrs = None  # CallRecords the switch reports calls to, if any
+        self.plan = None  # NumberPlan for dialled numbers that are not phones, if any
+        self.admission = None  # AdmissionControl for call setups, or None to admit them all
+
+    @property
+    def phones(self):
+        return self._phones
+
+    @phones.setter
+    def phones(self, phones):
+        # Always keep phones in a PhoneDirectory so the name index stays consistent
+        self._phones = phones if isinstance(phones, PhoneDirectory) else PhoneDirectory(phones)
+        self._phones.timers = self.timeouts
+        self._phones.history = self.history
+        if self.timeouts is not None:
+            # Phones that arrive ringing or offhook get their timers now
+            for code in (RINGING, OFFHOOK):
+                for phone in sorted(self._phones.states[code], key=lambda p: p.number):
+                    self.timeouts.transition(phone, code)
 
     def load_phones(self, filename):
         # Load phone numbers and names from a specified file
@@ -36,319 +809,902 @@ class TelephoneSystem:
                         if len(number) == 5 and number.isdigit() and len(name) <= 12 and name.isalpha():
                             self.phones[number] = Phone(number, name)
                         else:
-                            print(f"Ignored invalid entry: {line.strip()}")
+                            self.sink.emit(INVALID_ENTRY, line.strip())
+        self.report_duplicate_names()
+
+    def load_phones_bulk(self, filename, block_size=1 << 20):
+        # Same validation rules as load_phones, but the file is read in large blocks,
+        # each block is validated in one pass, and rejects are reported together.
+        # Returns (phones loaded, list of (line number, line) rejects).
+        start = time.perf_counter()
+        phones = self.phones
+        rejects = []
+        loaded = 0
+        lineno = 0
+        carry = ''
+        with open(filename, 'r') as file:
+            while True:
+                block = file.read(block_size)
+                if not block:
+                    break
+                lines = (carry + block).split('\n')
+                carry = lines.pop()  # Last piece may be an unfinished line
+                loaded += self._load_block(phones, lines, lineno, rejects)
+                lineno += len(lines)
+        if carry:
+            loaded += self._load_block(phones, [carry], lineno, rejects)
+        if rejects:
+            self.sink.emit(LOAD_REJECTS, rejects)
+        self.report_duplicate_names()
+        self.sink.emit(LOADED, loaded, time.perf_counter() - start)
+        return loaded, rejects
+
+    def _load_block(self, phones, lines, lineno, rejects):
+        # Validate a block of directory lines; lineno is the number of lines before it
+        loaded = 0
+        for offset, line in enumerate(lines, lineno + 1):
+            parts = line.split()
+            if len(parts) == 2:
+                number, name = parts
+                if len(number) == 5 and number.isdigit() and len(name) <= 12 and name.isalpha():
+                    phones[number] = Phone(number, name)
+                    loaded += 1
+                    continue
+            elif len(parts) < 2:
+                continue  # Blank and single-word lines are skipped silently, as in load_phones
+            # More than two words can never pass: the joined name would contain a space
+            rejects.append((offset, line.strip()))
+        return loaded
+
+    def compile_phone_index(self, filename, index_filename):
+        # Check a directory file as load_phones_bulk does, reporting rejects and
+        # duplicate names, and write its phones as an index for open_phone_index
+        from phoneindex import write_phone_index
+        scratch = TelephoneSystem(sink=self.sink)
+        loaded, rejects = scratch.load_phones_bulk(filename)
+        write_phone_index(scratch.phones, index_filename)
+        return loaded, rejects
+
+    def open_phone_index(self, index_filename):
+        # Serve the directory from a compiled index; phones are made as they are used
+        from phoneindex import LazyPhoneDirectory, PhoneIndex
+        self.phones = LazyPhoneDirectory(PhoneIndex(index_filename))
+
+    def report_duplicate_names(self):
+        # Ambiguous names are reported once when the index is built, not on every lookup
+        for name, numbers in self.phones.duplicate_names().items():
+            self.sink.emit(AMBIGUOUS_NAME, name, numbers)
+
+    def save_snapshot(self, filename):
+        # Write every phone and its live call state to a compact binary file
+        phones = list(self.phones.values())
+        index = {id(p): i for i, p in enumerate(phones)}
+        conferences = {}  # id of a shared participant list -> conference number
+        conference_words = []  # Each conference as its length followed by participant indexes
+        records = bytearray()
+        pack = SNAPSHOT_RECORD.pack
+        for p in phones:
+            call = p.current_call
+            if call is None:
+                kind, ref = CALL_NONE, -1
+            elif isinstance(call, Conference):
+                kind, ref = CALL_CONFERENCE, conferences.get(id(call), -1)
+                if ref < 0:
+                    ref = conferences[id(call)] = len(conferences)
+                    conference_words.append(len(call))
+                    conference_words.extend(index[id(member)] for member in call)
+            else:
+                kind, ref = CALL_PHONE, index[id(call)]
+            ringing = -1 if p.ringing_from is None else index[id(p.ringing_from)]
+            records += pack(p.state_code, p.call_type_code, kind, ref, ringing)
+        strings = '\0'.join(s for p in phones for s in (p.number, p.name)).encode('utf-8')
+        conference_data = struct.pack(f'<{len(conference_words)}I', *conference_words)
+        with open(filename, 'wb') as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(phones), len(conferences),
+                                            len(strings), len(conference_data), self.journal_sequence))
+            file.write(strings)
+            file.write(records)
+            file.write(conference_data)
+
+    def load_snapshot(self, filename):
+        # Replace the directory and all call state with the contents of a snapshot
+        with open(filename, 'rb') as file:
+            data = file.read()
+        magic = data[:len(SNAPSHOT_MAGIC)]
+        if magic == SNAPSHOT_MAGIC and len(data) >= SNAPSHOT_HEADER.size:
+            _, count, conference_count, strings_size, conference_size, sequence = SNAPSHOT_HEADER.unpack_from(data)
+            offset = SNAPSHOT_HEADER.size
+        elif magic == SNAPSHOT_MAGIC_V1 and len(data) >= SNAPSHOT_HEADER_V1.size:
+            _, count, conference_count, strings_size, conference_size = SNAPSHOT_HEADER_V1.unpack_from(data)
+            sequence = 0
+            offset = SNAPSHOT_HEADER_V1.size
+        else:
+            raise ValueError(f"{filename} is not a switch snapshot")
+        records_size = count * SNAPSHOT_RECORD.size
+        if len(data) != offset + strings_size + records_size + conference_size:
+            raise ValueError(f"{filename} is truncated or corrupt")
+        strings = data[offset:offset + strings_size].decode('utf-8').split('\0') if count else []
+        if len(strings) != 2 * count:
+            raise ValueError(f"{filename} is truncated or corrupt")
+        phones = [Phone(strings[i], strings[i + 1]) for i in range(0, 2 * count, 2)]
+        offset += strings_size
+        records = data[offset:offset + records_size]
+        offset += records_size
+        words = struct.unpack_from(f'<{conference_size // 4}I', data, offset)
+        conferences = []
+        position = 0
+        for _ in range(conference_count):
+            size = words[position]
+            conferences.append(Conference(phones[i] for i in words[position + 1:position + 1 + size]))
+            position += 1 + size
+        for p, (state, call_type, kind, ref, ringing) in zip(phones, SNAPSHOT_RECORD.iter_unpack(records)):
+            p.state_code = state
+            p.call_type_code = call_type
+            if kind == CALL_PHONE:
+                p.current_call = phones[ref]
+            elif kind == CALL_CONFERENCE:
+                p.current_call = conferences[ref]
+            if ringing >= 0:
+                p.ringing_from = phones[ringing]
+        restore_invites(phones)
+        self.phones = {p.number: p for p in phones}
+        self.journal_sequence = sequence
 
     def find_phone(self, identifier):
         # Find a phone by number or name
-        phone = self.phones.get(identifier)
+        phones = self._phones
+        phone = phones.get(identifier)
         if phone:
             return phone
-        for p in self.phones.values():
-            if p.name == identifier:
-                return p
-        return None
+        if type(identifier) is Phone:
+            return identifier  # Already looked up, e.g. by a parsed Command
+        return phones.by_name(identifier)
 
-    def status(self):
-        # Display the status of each phone in the system
-        for phone in self.phones.values():
-            print(phone)
+    def route(self, identifier):
+        # The phone a dialled identifier reaches: a phone by number or name, else
+        # whatever the number plan routes it to
+        phone = self.find_phone(identifier)
+        if phone is None and self.plan is not None:
+            phone = self.plan.route(self, identifier)
+        return phone
+
+    def load_number_plan(self, filename):
+        plan = NumberPlan()
+        plan.load(filename)
+        self.plan = plan
+        return plan
+
+    def status(self, state=None, prefix=None, changed=False):
+        # Display the status of each phone in the system. With state (a name such
+        # as 'ringing') or a number prefix, only matching phones are listed, in
+        # number order; with changed, only phones that changed since the last status.
+        phones = self.phones
+        if changed:
+            selected = phones.take_changed()
+        else:
+            phones.changed = set()
+            if prefix is not None:
+                selected = phones.with_prefix(prefix)
+            elif state is None:
+                selected = phones.values()
+            else:
+                selected = []
+            if state is not None:
+                code = STATE_CODES[state]
+                if prefix is None:
+                    selected = phones.in_state(code)
+                else:
+                    selected = [p for p in selected if p.state_code == code]
+        for phone in selected:
+            self.sink.emit(STATUS, phone.number, str(phone))
+
+    def participant_count(self, identifier):
+        # Parties on the phone's conference bridge, or 0 when it is not on one
+        phone = self.find_phone(identifier)
+        if phone and isinstance(phone.current_call, Conference):
+            return len(phone.current_call)
+        return 0
+
+    def state_counts(self):
+        # Number of phones in each state, by state name
+        return {name: self.phones.count(code) for code, name in enumerate(STATE_NAMES)}
+
+    def summary(self):
+        self.sink.emit(STATE_COUNTS, self.state_counts())
+
+    def enable_metrics(self):
+        # Start counting outcomes and timing the console entry points
+        if self.metrics is None:
+            self.metrics = Metrics()
+            self.metrics.attach(self)
+        return self.metrics
+
+    def disable_metrics(self):
+        if self.metrics is not None:
+            self.metrics.detach(self)
+            self.metrics = None
+
+    def report_metrics(self):
+        self.sink.emit(METRICS, self.metrics)
+
+    def report_cdrs(self):
+        self.sink.emit(CDR_REPORT, self.cdrs)
+
+    def report_admission(self):
+        self.sink.emit(ADMISSION_REPORT, self.admission)
+
+    def enable_history(self, depth=HISTORY_DEPTH, clock=time.time):
+        # Start keeping the last depth state changes of every phone
+        if self.history is None:
+            self.history = self._phones.history = PhoneHistory(depth, clock)
+        return self.history
+
+    def phone_history(self, identifier, count=None):
+        # The phone's last count state changes (all those kept by default), oldest
+        # first, as (time, state before, state after, call type) names; None when
+        # there is no such phone
+        phone = self.find_phone(identifier)
+        if phone is None:
+            return None
+        if self.history is None:
+            return []
+        return [(stamp, STATE_NAMES[before], STATE_NAMES[after], CALL_TYPE_NAMES[call_type])
+                for stamp, before, after, call_type in self.history.last(phone.number, count)]
+
+    def report_history(self, identifier):
+        phone = self.find_phone(identifier)
+        if phone:
+            entries = self.history.last(phone.number) if self.history is not None else None
+            self.sink.emit(HISTORY, phone, entries)
+        else:
+            self.sink.emit(NOT_FOUND, identifier)
 
     def offhook(self, identifier):
         # Put a phone offhook
         phone = self.find_phone(identifier)
         if phone:
-            if phone.state in ['offhook', 'dialing', 'calling', 'connected']:
+            if phone.state_code in OFFHOOK_STATES:
                 # Already offhook or in a call
-                print(f"{phone.name} is already offhook.")
+                self.sink.emit(ALREADY_OFFHOOK, phone.name)
             else:
-                phone.state = 'offhook'
-                print(f"{phone.name} hears dialtone.")
+                self._phones.set_state(phone, OFFHOOK)
+                self.sink.emit(HEARS, phone.name, 'dialtone')
         else:
-            print(f"Phone {identifier} not found.")
+            self.sink.emit(NOT_FOUND, identifier)
 
     def onhook(self, identifier):
         # Put a phone onhook
         phone = self.find_phone(identifier)
         if phone:
-            if phone.state == 'onhook':
-                print(f"{phone.name} is already onhook.")
+            if phone.state_code == ONHOOK:
+                self.sink.emit(ALREADY_ONHOOK, phone.name)
             else:
                 # Disconnect from any calls
                 if phone.current_call:
-                    if isinstance(phone.current_call, list):
+                    if self.cdrs is not None:
+                        self.cdrs.hangup(phone)
+                    if isinstance(phone.current_call, Conference):
                         # Conference call
                         participants = phone.current_call
-                        participants.remove(phone)
-                        if len(participants) > 2:
-                            # Update current_call for remaining participants
-                            for p in participants:
-                                p.current_call = participants
+                        participants.leave(phone)
+                        for invited in participants.invited_by(phone):
+                            # Nobody is left to add the party being invited
+                            participants.withdraw(invited)
+                            invited.ringing_from = None
+                            if self.cdrs is not None:
+                                self.cdrs.unanswered(phone, invited, CONFERENCE)
+                            self._phones.set_state(invited, OFFHOOK)
+                            self.sink.emit(HEARS, invited.name, 'silence')
+                        if len(participants) > 2 or len(participants) == 2 and participants.pending:
+                            # Remaining participants keep sharing the bridge, and an invitation
+                            # still ringing can complete it
+                            self._phones.touch(participants)  # Their list of other parties changed
                         elif len(participants) == 2:
                             # Two participants left revert to normal call
                             remaining_phone1, remaining_phone2 = participants
                             remaining_phone1.current_call = remaining_phone2
                             remaining_phone2.current_call = remaining_phone1
-                            remaining_phone1.state = 'connected'
-                            remaining_phone2.state = 'connected'
-                            print(f"{remaining_phone1.name} and {remaining_phone2.name} are talking.")
+                            self._phones.set_state(remaining_phone1, CONNECTED)
+                            self._phones.set_state(remaining_phone2, CONNECTED)
+                            self.sink.emit(TALKING, remaining_phone1.name, remaining_phone2.name)
                         elif len(participants) == 1:
                             # Only one participant left
-                            remaining_phone = participants[0]
-                            remaining_phone.current_call = None
-                            remaining_phone.state = 'offhook'
+                            remaining_phone, = participants
+                            if self.cdrs is not None:
+                                self.cdrs.hangup(remaining_phone)
+                            invited = participants.invited_by(remaining_phone)
+                            if invited:
+                                # Its invitation is all that is left: it carries on as a plain call
+                                participants.withdraw(invited[0])
+                                remaining_phone.current_call = invited[0]
+                                remaining_phone.call_type_code = NORMAL
+                            else:
+                                remaining_phone.current_call = None
+                                self._phones.set_state(remaining_phone, OFFHOOK)
                         phone.current_call = None # Clear current_call
-                        print(f"{phone.name} hangs up from conference.")
+                        self.sink.emit(LEFT_CONFERENCE, phone.name)
                     else:
                         # Normal call
                         other = phone.current_call
                         other.current_call = None
-                        if other.state != 'onhook':
-                            other.state = 'offhook'
-                            print(f"{other.name} hears silence.")
+                        if self.cdrs is not None:
+                            if other.state_code == RINGING:
+                                self.cdrs.unanswered(phone, other, NORMAL)  # Caller gave up
+                            else:
+                                # The other end's conversation is over too, even when it is
+                                # filed under it alone (a party conferenced into a bridge
+                                # that fell back to a two-party call)
+                                self.cdrs.hangup(other)
+                        if other.state_code != ONHOOK:
+                            self._phones.set_state(other, OFFHOOK)
+                            self.sink.emit(HEARS, other.name, 'silence')
                         phone.current_call = None
-                    phone.state = 'onhook'
-                elif phone.state == 'ringing':
-                    # Missed call
-                    phone.state = 'onhook'
-                    caller = phone.ringing_from
-                    if caller and caller.state == 'calling': # Check if caller is still calling 
-                        if caller.call_type == 'normal': 
-                            # Missed normal call
-                            print(f"{caller.name} hears silence.")
-                            caller.state = 'offhook'
-                            caller.current_call = None
-                        elif caller.call_type == 'transfer': 
-                            # Failed transfer
-                            caller.state = 'connected'
-                            caller.current_call = caller.current_call
-                            print(f"Transfer to {phone.name} failed.")
-                            print(f"{caller.name} and {caller.current_call.name} are talking.")
-                            phone.ringing_from.call_type = 'normal'
-                            caller.current_call.call_type = 'normal'
-                        elif caller.call_type == 'conference':
-                            # Failed Conference
-                            # Unpack participants
-                            remaining_phone1, remaining_phone2 = caller.current_call[0], caller.current_call[1] 
-                            # Reset states
-                            remaining_phone1.state, remaining_phone2.state = 'connected', 'connected'
-                            # Reset failed conference call to normal call
-                            remaining_phone1.current_call, remaining_phone2.current_call = remaining_phone2, remaining_phone1
-                            # Reset call types
-                            remaining_phone1.call_type, remaining_phone2.call_type = 'normal', 'normal'
-                            print(f"Conference call failed.")
-                            print(f"{remaining_phone1.name} and {remaining_phone2.name} are talking.")
-                    phone.ringing_from = None
+                    self._phones.set_state(phone, ONHOOK)
+                elif phone.state_code == RINGING:
+                    self._missed_call(phone)
                 else:
-                    phone.state = 'onhook'
-                print(f"{phone.name} is now onhook.")
+                    self._phones.set_state(phone, ONHOOK)
+                self.sink.emit(NOW_ONHOOK, phone.name)
+        else:
+            self.sink.emit(NOT_FOUND, identifier)
+
+    def _missed_call(self, phone):
+        # A ringing phone stopped ringing unanswered: put its caller back where it was
+        self._phones.set_state(phone, ONHOOK)
+        caller = phone.ringing_from
+        if self.cdrs is not None and caller:
+            self.cdrs.unanswered(caller, phone, caller.call_type_code if caller.state_code == CALLING else NORMAL)
+        if caller and caller.state_code == CALLING: # Check if caller is still calling 
+            if caller.call_type_code == NORMAL: 
+                # Missed normal call
+                self.sink.emit(HEARS, caller.name, 'silence')
+                self._phones.set_state(caller, OFFHOOK)
+                caller.current_call = None
+            elif caller.call_type_code == TRANSFER: 
+                # Failed transfer
+                self._phones.set_state(caller, CONNECTED)
+                caller.current_call = caller.current_call
+                self.sink.emit(TRANSFER_FAILED, phone.name)
+                self.sink.emit(TALKING, caller.name, caller.current_call.name)
+                phone.ringing_from.call_type_code = NORMAL
+                caller.current_call.call_type_code = NORMAL
+            elif caller.call_type_code == CONFERENCE and (len(caller.current_call) > 2 or
+                                                          len(caller.current_call.pending) > 1):
+                # Failed to add a party to an existing bridge: the caller rejoins it
+                participants = caller.current_call
+                participants.withdraw(phone)
+                self._phones.set_state(caller, CONNECTED)
+                caller.call_type_code = NORMAL
+                self._phones.touch(participants)
+                self.sink.emit(CONFERENCE_FAILED)
+                self.sink.emit(CONFERENCE_TALKING, [p.name for p in participants])
+            elif caller.call_type_code == CONFERENCE:
+                # Failed Conference
+                caller.current_call.withdraw(phone)
+                # Unpack participants
+                remaining_phone1, remaining_phone2 = caller.current_call
+                # Reset states
+                self._phones.set_state(remaining_phone1, CONNECTED)
+                self._phones.set_state(remaining_phone2, CONNECTED)
+                # Reset failed conference call to normal call
+                remaining_phone1.current_call, remaining_phone2.current_call = remaining_phone2, remaining_phone1
+                # Reset call types
+                remaining_phone1.call_type_code, remaining_phone2.call_type_code = NORMAL, NORMAL
+                self.sink.emit(CONFERENCE_FAILED)
+                self.sink.emit(TALKING, remaining_phone1.name, remaining_phone2.name)
+        phone.ringing_from = None
+
+    def timeout(self, identifier):
+        # A phone's timer ran out: it rang unanswered, or sat on dialtone or silence
+        phone = self.find_phone(identifier)
+        if not phone:
+            self.sink.emit(NOT_FOUND, identifier)
+        elif phone.state_code == RINGING:
+            self.sink.emit(NO_ANSWER, phone.name)
+            self._missed_call(phone)
+        elif phone.state_code == OFFHOOK:
+            # Abandoned handset: release the line instead of holding it forever
+            self._phones.set_state(phone, ONHOOK)
+            self.sink.emit(DIALTONE_TIMEOUT, phone.name)
         else:
-            print(f"Phone {identifier} not found.")
+            self.sink.emit(HEARS, phone.name, 'denial')
 
     def call(self, caller_id, receiver_id):
         # Initiate a call from one phone to another
         caller = self.find_phone(caller_id)
-        receiver = self.find_phone(receiver_id)
+        receiver = self.route(receiver_id)
 
         if not caller:
-            print(f"Caller {caller_id} not found.")
+            self.sink.emit(CALLER_NOT_FOUND, caller_id)
             return
         if not receiver:
-            print(f"{caller.name} hears denial.")
+            self.sink.emit(HEARS, caller.name, 'denial')
             return
 
-        if caller.state != 'offhook':
-            print(f"{caller.name} hears silence.")
+        if caller.state_code != OFFHOOK:
+            self.sink.emit(HEARS, caller.name, 'silence')
             return
 
-        if receiver.state == 'onhook':
+        if receiver.state_code == ONHOOK:
+            if self.admission is not None and not self.admission.admit(caller, 'call'):
+                self.sink.emit(SHED, caller.name)
+                return
             # Set up the call
-            caller.state = 'calling'
+            caller.call_type_code = NORMAL  # Reset call_type to 'normal' when initiating a normal call
+            self._phones.set_state(caller, CALLING)
             caller.current_call = receiver
-            caller.call_type = 'normal'  # Reset call_type to 'normal' when initiating a normal call
-            receiver.state = 'ringing'
+            self._phones.set_state(receiver, RINGING)
             receiver.ringing_from = caller
-            print(f"{caller.name} hears ringback.")
-            print(f"{receiver.name} hears ringing.")
-        elif receiver.state in ['offhook', 'dialing', 'calling', 'connected', 'ringing']:
-            print(f"{caller.name} hears busy.")
+            if self.cdrs is not None:
+                self.cdrs.ringing(receiver)
+            self.sink.emit(HEARS, caller.name, 'ringback')
+            self.sink.emit(HEARS, receiver.name, 'ringing')
+        elif receiver.state_code in BUSY_STATES:
+            self.sink.emit(HEARS, caller.name, 'busy')
         else:
-            print(f"{caller.name} hears denial.")
+            self.sink.emit(HEARS, caller.name, 'denial')
 
     def answer_call(self, identifier):
         # Answer a ringing phone
         phone = self.find_phone(identifier)
         if phone:
-            if phone.state == 'ringing':
+            if phone.state_code == RINGING:
                 caller = phone.ringing_from
                 if not caller:
-                    print(f"Error: No caller information.")
+                    self.sink.emit(NO_CALLER)
                     return
-                if caller.state == 'calling' and caller.current_call:
-                    if caller.call_type == 'conference':
+                if self.cdrs is not None:
+                    calling = caller.state_code == CALLING and caller.current_call
+                    self.cdrs.answered(caller, phone, caller.call_type_code if calling else NORMAL, caller.current_call)
+                if caller.state_code == CALLING and caller.current_call:
+                    if caller.call_type_code == CONFERENCE:
                         # Conference call
-                        if isinstance(caller.current_call, list):
+                        if isinstance(caller.current_call, Conference):
                             participants = caller.current_call
                         else:
-                            participants = [caller, caller.current_call]
+                            participants = Conference((caller, caller.current_call))
                         # Check if phone is already in participants
                         if phone not in participants:
-                            participants.append(phone)
-                        for p in participants:
+                            participants.join(phone)
+                        # A bridge just formed from a two-party call has all three parties to
+                        # link; on a larger bridge only the caller and the new party are not
+                        # already connected to it
+                        for p in participants if len(participants) == 3 else (caller, phone):
                             p.current_call = participants
-                            p.state = 'connected'
-                        phone.state = 'connected'
-                        print(f"{', '.join([p.name for p in participants])} are talking.")
-                    elif caller.call_type == 'transfer':
+                            self._phones.set_state(p, CONNECTED)
+                        self._phones.touch(participants)
+                        self.sink.emit(CONFERENCE_TALKING, [p.name for p in participants])
+                    elif caller.call_type_code == TRANSFER:
                         # Transfer call
                         other_party = caller.current_call
                         # Connect other_party and phone
                         other_party.current_call = phone
-                        other_party.state = 'connected'
+                        self._phones.set_state(other_party, CONNECTED)
                         phone.current_call = other_party
-                        phone.state = 'connected'
+                        self._phones.set_state(phone, CONNECTED)
                         # Disconnect caller
                         caller.current_call = None
-                        caller.state = 'offhook'
-                        print(f"{other_party.name} and {phone.name} are talking.")
-                        print(f"{caller.name} hears silence.")
+                        self._phones.set_state(caller, OFFHOOK)
+                        self.sink.emit(TALKING, other_party.name, phone.name)
+                        self.sink.emit(HEARS, caller.name, 'silence')
                     else:
                         # Normal call
-                        phone.state = 'connected'
+                        self._phones.set_state(phone, CONNECTED)
                         phone.current_call = caller
-                        caller.state = 'connected'
+                        self._phones.set_state(caller, CONNECTED)
                         caller.current_call = phone
-                        print(f"{caller.name} and {phone.name} are talking.")
+                        self.sink.emit(TALKING, caller.name, phone.name)
                     # Clear ringing_from and reset call_type
                     phone.ringing_from = None
-                    caller.call_type = 'normal'
+                    caller.call_type_code = NORMAL
                 else:
                     # Normal call
-                    phone.state = 'connected'
+                    self._phones.set_state(phone, CONNECTED)
                     phone.current_call = caller
-                    caller.state = 'connected'
+                    self._phones.set_state(caller, CONNECTED)
                     caller.current_call = phone
-                    print(f"{caller.name} and {phone.name} are talking.")
+                    self.sink.emit(TALKING, caller.name, phone.name)
                     phone.ringing_from = None
             else:
-                print(f"{phone.name} is not ringing.")
+                self.sink.emit(NOT_RINGING, phone.name)
         else:
-            print(f"Phone {identifier} not found.")
+            self.sink.emit(NOT_FOUND, identifier)
 
     def transfer(self, identifier, new_receiver_id):
         # Transfer an ongoing call to a new phone
         caller = self.find_phone(identifier)
-        new_receiver = self.find_phone(new_receiver_id)
+        new_receiver = self.route(new_receiver_id)
 
         if not caller or not new_receiver:
-            print(f"{identifier} hears denial.")
+            self.sink.emit(HEARS, identifier, 'denial')
             return
 
-        if caller.state != 'connected' or not caller.current_call:
-            print(f"{caller.name} hears denial.")
+        if caller.state_code != CONNECTED or not caller.current_call:
+            self.sink.emit(HEARS, caller.name, 'denial')
             return
 
         other_party = caller.current_call
-        if isinstance(other_party, list):
+        if isinstance(other_party, Conference):
             # Cannot transfer a conference call
-            print(f"{caller.name} hears denial.")
+            self.sink.emit(HEARS, caller.name, 'denial')
             return
 
-        if new_receiver.state == 'onhook':
+        if new_receiver.state_code == ONHOOK:
+            if self.admission is not None and not self.admission.admit(caller, 'transfer'):
+                self.sink.emit(SHED, caller.name)
+                return
             # Begin transfer process
-            caller.state = 'calling'
-            caller.call_type = 'transfer'  # Set call type
+            caller.call_type_code = TRANSFER  # Set call type
+            self._phones.set_state(caller, CALLING)
             caller.current_call = other_party  # Keep track of the other party
-            new_receiver.state = 'ringing'
+            self._phones.set_state(new_receiver, RINGING)
             new_receiver.ringing_from = caller
-            print(f"{caller.name} hears ringback.")
-            print(f"{new_receiver.name} hears ringing.")
+            if self.cdrs is not None:
+                self.cdrs.ringing(new_receiver)
+            self.sink.emit(HEARS, caller.name, 'ringback')
+            self.sink.emit(HEARS, new_receiver.name, 'ringing')
         else:
-            print(f"{caller.name} hears denial.")
+            self.sink.emit(HEARS, caller.name, 'denial')
 
     def conference(self, identifier, third_party_id):
         # Add a third party to an ongoing call
         caller = self.find_phone(identifier)
-        third_party = self.find_phone(third_party_id)
+        third_party = self.route(third_party_id)
 
         if not caller or not third_party:
-            print(f"{identifier} hears denial.")
+            self.sink.emit(HEARS, identifier, 'denial')
             return
 
-        if caller.state != 'connected' or not caller.current_call:
-            print(f"{caller.name} hears denial.")
+        if caller.state_code != CONNECTED or not caller.current_call:
+            self.sink.emit(HEARS, caller.name, 'denial')
             return
 
-        if third_party.state == 'onhook':
+        if third_party.state_code == ONHOOK:
             other_party = caller.current_call
-            if isinstance(other_party, list):
+            if isinstance(other_party, Conference):
                 participants = other_party
             else:
-                participants = [caller, other_party]
-            if len(participants) >= 3:
-                print(f"{caller.name} hears denial.")
+                participants = Conference((caller, other_party))
+            if len(participants) + len(participants.pending) >= self.conference_limit:
+                self.sink.emit(HEARS, caller.name, 'denial')
                 return
-            participants.append(third_party)
+            if self.admission is not None and not self.admission.admit(caller, 'conference'):
+                self.sink.emit(SHED, caller.name)
+                return
+            participants.invite(third_party, caller)
             caller.current_call = participants
-            caller.state = 'calling'
-            caller.call_type = 'conference'  # Set call type
-            third_party.state = 'ringing'
+            caller.call_type_code = CONFERENCE  # Set call type
+            self._phones.set_state(caller, CALLING)
+            self._phones.set_state(third_party, RINGING)
             third_party.ringing_from = caller
-            print(f"{caller.name} hears ringback.")
-            print(f"{third_party.name} hears ringing.")
+            if self.cdrs is not None:
+                self.cdrs.ringing(third_party)
+            self.sink.emit(HEARS, caller.name, 'ringback')
+            self.sink.emit(HEARS, third_party.name, 'ringing')
         else:
-            print(f"{caller.name} hears denial.")
+            self.sink.emit(HEARS, caller.name, 'denial')
 
     def pickup(self, identifier):
         # Handle a phone going offhook
         phone = self.find_phone(identifier)
         if not phone:
-            print(f"Phone {identifier} not found.")
+            self.sink.emit(NOT_FOUND, identifier)
             return
 
-        if phone.state == 'onhook':
+        if phone.state_code == ONHOOK:
             self.offhook(identifier)
-            phone.call_type = 'normal'  # Reset call_type to 'normal' when going offhook
-        elif phone.state == 'ringing':
+            phone.call_type_code = NORMAL  # Reset call_type to 'normal' when going offhook
+        elif phone.state_code == RINGING:
             self.answer_call(identifier)
-        elif phone.state in ['offhook', 'dialing', 'calling', 'connected']:
-            print(f"{phone.name} hears silence.")
+        elif phone.state_code in OFFHOOK_STATES:
+            self.sink.emit(HEARS, phone.name, 'silence')
         else:
-            print(f"{phone.name} hears denial.")
+            self.sink.emit(HEARS, phone.name, 'denial')
 
 
-def main():
-    system = TelephoneSystem()
-    system.load_phones('phones.txt')
+# Console verbs. A phone command is "<phone> <verb> [<phone>...]" and a switch
+# command is "<verb> [<argument>...]". A handler is the name of a TelephoneSystem
+# method, called as system.<name>(*operands) so per-instance wrappers such as
+# metrics see it, or any function called as handler(system, *operands).
+PHONE_COMMANDS = {}   # verb -> (handler, phones named after the verb)
+SWITCH_COMMANDS = {}  # argument count -> {verb: handler}
+# Phone commands the switch issues itself, such as timer expiries. They are
+# journaled like any other command and replayed from the journal, but are not
+# accepted from a console or a connection.
+INTERNAL_COMMANDS = {"timeout": ("timeout", 0)}
 
-    while True:
-        command = input("Enter command: ").strip()
-        if not command:
-            continue
-        command_parts = command.split()
-        if command.lower() == "status":
-            system.status()
-        elif len(command_parts) == 2:
-            phone_id, action = command_parts
-            action = action.lower()
-            if action == "offhook":
-                system.pickup(phone_id)
-            elif action == "onhook":
-                system.onhook(phone_id)
-            else:
-                print("Invalid command.")
-        elif len(command_parts) == 3:
-            phone_id, action, target_id = command_parts
-            action = action.lower()
-            if action == "call":
-                system.call(phone_id, target_id)
-            elif action == "transfer":
-                system.transfer(phone_id, target_id)
-            elif action == "conference":
-                system.conference(phone_id, target_id)
-            else:
-                print("Invalid command.")
+
+def phone_command(verb, targets, handler):
+    # Register "<phone> <verb>" followed by `targets` more phones
+    PHONE_COMMANDS[verb] = (handler, targets)
+
+
+def switch_command(verb, arguments, handler):
+    # Register "<verb>" followed by `arguments` words
+    SWITCH_COMMANDS.setdefault(arguments, {})[verb] = handler
+
+
+def invalid_command(system, *operands):
+    system.sink.emit(INVALID_COMMAND)
+
+
+def switch_form(words):
+    # Handler if the line is a registered switch command, else None
+    handlers = SWITCH_COMMANDS.get(len(words) - 1)
+    return None if handlers is None else handlers.get(words[0].lower())
+
+
+def phone_form(words, verbs=PHONE_COMMANDS):
+    # (handler, operands, operands are phones) reading the line as a phone command
+    # Verbs are nearly always typed in lower case already
+    entry = verbs.get(words[1]) or verbs.get(words[1].lower()) if len(words) > 1 else None
+    if entry is None or len(words) != entry[1] + 2:
+        return invalid_command, words, False
+    return entry[0], [words[0]] + words[2:], True
+
+
+def call_handler(system, handler, operands):
+    if handler.__class__ is str:
+        getattr(system, handler)(*operands)
+    else:
+        handler(system, *operands)
+
+
+def dispatch(system, words, switch, handler, operands):
+    # Run a parsed line: its switch handler, if it has one, else its phone handler.
+    # A switch verb with arguments ("status onhook") yields to a phone of that name.
+    if switch is not None and (len(words) == 1 or not system.find_phone(words[0])):
+        call_handler(system, switch, words[1:])
+    else:
+        call_handler(system, handler, operands)
+
+
+class Command:
+    # A parsed console line, reusable by any front end and across runs. A command
+    # run again against the same directory looks its phones up once and keeps
+    # them until the directory changes. Operands are passed on as phones only when
+    # all of them resolved, so not-found messages still show what was typed.
+    __slots__ = ('words', 'switch', 'handler', 'identifiers', 'phones', 'operands', 'directory', 'generation')
+
+    def __init__(self, words, verbs=PHONE_COMMANDS):
+        self.words = words
+        self.switch = switch_form(words)
+        self.handler, self.identifiers, self.phones = phone_form(words, verbs)
+        self.operands = self.identifiers
+        self.directory = None
+        self.generation = -1
+
+    def run(self, system):
+        if self.phones:
+            phones = system._phones
+            if self.directory is not phones or self.generation != phones.generation:
+                # First run here, or the directory changed since the phones were found
+                self.operands = self.identifiers
+                self.directory = phones
+                self.generation = phones.generation
+            elif self.operands is self.identifiers:
+                # Running again: worth looking the phones up once
+                found = [system.find_phone(identifier) for identifier in self.identifiers]
+                if None not in found:
+                    self.operands = found
+        dispatch(system, self.words, self.switch, self.handler, self.operands)
+
+
+def parse_command(line, verbs=PHONE_COMMANDS):
+    # Parse one console line into a Command; None for a blank line. verbs are the
+    # phone commands to accept.
+    words = line.split()
+    return Command(words, verbs) if words else None
+
+
+def internal_command(line):
+    # Parse a line that may be one of the switch's own commands, as in a journal
+    return parse_command(line, {**PHONE_COMMANDS, **INTERNAL_COMMANDS})
+
+
+def run_command(system, command):
+    # Run a single console command, given as text or as a parsed Command; returns
+    # False for blank lines. Text goes through the same parse and dispatch as a
+    # Command, without keeping anything for a second run.
+    if command.__class__ is Command:
+        command.run(system)
+        return True
+    words = command.split()
+    if not words:
+        return False
+    handler, operands, _ = phone_form(words)
+    dispatch(system, words, switch_form(words), handler, operands)
+    return True
+
+
+def run_status_query(system, query):
+    # status <state> | status <number prefix> | status changed | status summary
+    if query in STATE_CODES:
+        system.status(state=query)
+    elif query.isdigit():
+        system.status(prefix=query)
+    elif query == "changed":
+        system.status(changed=True)
+    elif query == "summary":
+        system.summary()
+    else:
+        system.sink.emit(INVALID_COMMAND)
+
+
+phone_command("offhook", 0, "pickup")
+phone_command("onhook", 0, "onhook")
+phone_command("call", 1, "call")
+phone_command("transfer", 1, "transfer")
+phone_command("conference", 1, "conference")
+phone_command("history", 0, "report_history")
+switch_command("status", 0, "status")
+switch_command("status", 1, lambda system, query: run_status_query(system, query.lower()))
+switch_command("metrics", 0, "report_metrics")
+switch_command("cdr", 0, "report_cdrs")
+switch_command("admission", 0, "report_admission")
+
+
+def run_timers(system, execute=run_command):
+    # Fire every expired timer as a "<number> timeout" command, so timeouts are
+    # reported, and journaled, like any other command; returns how many fired
+    if system.timeouts is None:
+        return 0
+    expired = system.timeouts.expire()
+    for phone in expired:
+        execute(system, internal_command(f"{phone.number} timeout"))
+    return len(expired)
+
+
+def run_batch(system, source, out=None, chunk_size=1 << 16, execute=run_command):
+    # Replay commands from a file-like source without prompting.
+    # Output goes through a buffered TextSink; returns (commands, seconds).
+    # execute runs each command, e.g. Journal.run to journal them.
+    previous = system.sink
+    system.sink = TextSink(out, buffer_size=chunk_size)
+    count = 0
+    timed = system.timeouts is not None
+    start = time.perf_counter()
+    try:
+        for line in source:
+            if timed:
+                run_timers(system, execute)  # Timers due by now fire before the next command
+            if execute(system, line):
+                count += 1
+    finally:
+        system.sink.flush()
+        system.sink = previous
+    return count, time.perf_counter() - start
+
+
+def report_throughput(count, elapsed, stream=None):
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {count} commands in {elapsed:.3f}s ({rate:.0f} commands/sec).",
+          file=stream if stream is not None else sys.stderr)
+
+
+def run_session(system, args, execute=run_command):
+    # Drive the switch from a batch file or the interactive prompt
+    if args.batch is not None:
+        if args.batch == '-':
+            count, elapsed = run_batch(system, sys.stdin, execute=execute)
         else:
-            print("Invalid command.")
+            with open(args.batch, 'r') as source:
+                count, elapsed = run_batch(system, source, execute=execute)
+        report_throughput(count, elapsed)
+        return
+
+    while True:
+        try:
+            command = input("Enter command: ")
+        except EOFError:
+            break
+        run_timers(system, execute)
+        execute(system, command)
+
+
+def replay_session(system, filename, verify=False):
+    # Rebuild state from a journal and report how it went on stderr
+    from journal import replay_journal
+    start = time.perf_counter()
+    count, mismatches = replay_journal(system, filename, verify)
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"Replayed {count} journal entries in {elapsed:.3f}s ({rate:.0f} entries/sec), "
+          f"now at sequence {system.journal_sequence}.", file=sys.stderr)
+    for sequence in mismatches:
+        print(f"Journal entry {sequence} replayed with different transitions.", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Telephone switch simulator")
+    parser.add_argument('--phones', default='phones.txt', help="directory file to load")
+    parser.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                        help="replay commands from FILE (or stdin) without prompting")
+    parser.add_argument('--plan', metavar='FILE', help="route dialled numbers that are not phones by number plan FILE")
+    parser.add_argument('--index', metavar='FILE',
+                        help="serve the directory from index FILE, compiled from --phones when missing or older")
+    parser.add_argument('--restore', metavar='SNAPSHOT', help="start from a saved snapshot instead of the directory")
+    parser.add_argument('--snapshot', metavar='SNAPSHOT', help="save a snapshot of the switch on exit")
+    parser.add_argument('--journal', metavar='FILE',
+                        help="recover from FILE's entries newer than the starting state, then journal to it")
+    parser.add_argument('--group-commit', type=int, default=256, metavar='N',
+                        help="most journal entries per write and fsync")
+    parser.add_argument('--commit-window', type=float, default=10.0, metavar='MS',
+                        help="longest a journal entry waits for its group to be written")
+    parser.add_argument('--no-fsync', action='store_true', help="write the journal without syncing it to disk")
+    parser.add_argument('--ring-timeout', type=float, metavar='SEC',
+                        help="a phone that rings this long unanswered stops ringing")
+    parser.add_argument('--dialtone-timeout', type=float, metavar='SEC',
+                        help="a phone left offhook without a call this long is released")
+    parser.add_argument('--metrics', action='store_true',
+                        help="count command outcomes and latencies; the metrics command prints them")
+    parser.add_argument('--call-rate', type=float, metavar='PER_SEC',
+                        help="most call setups (call, transfer, conference) per second across the switch")
+    parser.add_argument('--call-burst', type=float, metavar='N', help="setups the switch may take at once (default: the rate)")
+    parser.add_argument('--phone-call-rate', type=float, metavar='PER_SEC', help="most call setups per second from one phone")
+    parser.add_argument('--phone-call-burst', type=float, metavar='N', help="setups one phone may make at once (default: the rate)")
+    parser.add_argument('--history', type=int, metavar='N',
+                        help="keep each phone's last N state changes; '<phone> history' prints them")
+    parser.add_argument('--cdr', metavar='DIR', help="keep call detail records in DIR; the cdr command summarises them")
+    parser.add_argument('--replay', metavar='FILE', help="rebuild state from journal FILE and exit")
+    parser.add_argument('--verify', action='store_true', help="with --replay, check each entry's transitions")
+    args = parser.parse_args(argv)
+    # The subsystem modules import from this one, so they are only imported once it is loaded
+    from cdr import CallRecords
+    from journal import Journal
+    from timers import Timeouts
+
+    timeouts = None
+    if args.ring_timeout is not None or args.dialtone_timeout is not None:
+        timeouts = Timeouts(ring=args.ring_timeout, dialtone=args.dialtone_timeout)
+    # Directory diagnostics and the load rate go to stderr, away from command output
+    system = TelephoneSystem(sink=TextSink(sys.stderr), timeouts=timeouts)
+    if args.restore:
+        system.load_snapshot(args.restore)
+    elif args.index:
+        if not os.path.exists(args.index) or os.path.getmtime(args.index) < os.path.getmtime(args.phones):
+            system.compile_phone_index(args.phones, args.index)
+        system.open_phone_index(args.index)
+    else:
+        system.load_phones_bulk(args.phones)
+    if args.plan:
+        system.load_number_plan(args.plan)
+    if args.metrics:
+        system.enable_metrics()
+    journal = None
+    try:
+        if args.replay:
+            replay_session(system, args.replay, args.verify)
+            return
+        if args.journal:
+            if os.path.exists(args.journal):
+                replay_session(system, args.journal)
+            # At the prompt nothing else would fill the group, so commit every command
+            group_size = args.group_commit if args.batch is not None else 1
+            journal = Journal(args.journal, group_size, args.commit_window / 1000, not args.no_fsync)
+        if args.call_rate is not None or args.phone_call_rate is not None:
+            # Only once recovery is done: replayed commands were admitted the first time
+            system.admission = AdmissionControl(args.call_rate, args.call_burst,
+                                                args.phone_call_rate, args.phone_call_burst)
+        if args.history:
+            # Likewise, replayed changes would all be stamped with the time of the replay
+            system.enable_history(args.history)
+        if args.cdr:
+            # And replayed calls are already in the records from their first run
+            system.cdrs = CallRecords(args.cdr)
+        system.sink = TextSink()
+        run_session(system, args, journal.run if journal else run_command)
+    finally:
+        if journal:
+            journal.close()
+        if system.cdrs is not None:
+            system.cdrs.flush()
+        if args.snapshot:
+            system.save_snapshot(args.snapshot)
+
 
 if __name__ == "__main__":
-    main()
+    # Run the copy imported as main, the one cdr, journal and the other subsystem
+    # modules import their names from, rather than this __main__ one
+    import main as switch
+    switch.main()
@@ -0,0 +1,272 @@
+import array
+import bisect
+import mmap
+import struct
+import sys
+import threading
+
+from main import ONHOOK, Phone, PhoneDirectory
+
+# Compiled directory index: header, then one fixed-width record per phone sorted by
+# number (number and name, NUL-padded UTF-8), then the record positions in name
+# order and in directory order. Name order lists a name's phones in the order they
+# were registered, so the first one is the phone by_name would find.
+INDEX_MAGIC = b'TIDX\x00\x00\x00\x01'
+INDEX_HEADER = struct.Struct('<8sIHH')  # magic, phones, number width, name width
+
+def write_phone_index(phones, filename):
+    # Write a PhoneDirectory's phones as an index that LazyPhoneDirectory can open
+    numbers = list(phones)
+    encoded = [number.encode('utf-8') for number in numbers]
+    names = [phones[number].name.encode('utf-8') for number in numbers]
+    registered = {p.number: i for i, p in enumerate(p for holders in phones.names.values() for p in holders)}
+    by_number = sorted(range(len(numbers)), key=encoded.__getitem__)
+    order = array.array('I', bytes(4 * len(numbers)))  # Directory position -> record
+    for record, i in enumerate(by_number):
+        order[i] = record
+    by_name = array.array('I', sorted(range(len(numbers)), key=lambda record: (
+        names[by_number[record]], registered[numbers[by_number[record]]])))
+    number_width = max(map(len, encoded), default=0)
+    name_width = max(map(len, names), default=0)
+    with open(filename, 'wb') as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(numbers), number_width, name_width))
+        file.write(b''.join(encoded[i].ljust(number_width, b'\0') + names[i].ljust(name_width, b'\0')
+                            for i in by_number))
+        for column in (by_name, order):
+            if sys.byteorder != 'little':
+                column.byteswap()
+            column.tofile(file)
+
+
+class PhoneIndex:
+    # Read-only view of a compiled directory index. The file is memory-mapped, so
+    # opening it reads nothing but the header; a lookup is a binary search that
+    # only touches the pages it passes through.
+    def __init__(self, filename=None):
+        self.map = None
+        self.count = self.number_width = self.name_width = 0
+        self.by_name = self.order = ()
+        if filename is None:
+            return  # An empty index
+        with open(filename, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.number_width, self.name_width = INDEX_HEADER.unpack_from(self.map)
+        self.width = self.number_width + self.name_width
+        size = INDEX_HEADER.size + self.count * (self.width + 8)
+        if magic != INDEX_MAGIC or len(self.map) != size:
+            self.map.close()
+            raise ValueError(f"{filename} is not a phone index")
+        start = INDEX_HEADER.size + self.count * self.width
+        view = memoryview(self.map)
+        for name, offset in (('by_name', start), ('order', start + 4 * self.count)):
+            column = view[offset:offset + 4 * self.count].cast('I')
+            if sys.byteorder != 'little':
+                column = array.array('I', column)
+                column.byteswap()
+            setattr(self, name, column)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.map is not None:
+            for column in (self.by_name, self.order):
+                if isinstance(column, memoryview):
+                    column.release()
+            self.map.close()
+            self.map = None
+
+    def _number(self, record):
+        offset = INDEX_HEADER.size + record * self.width
+        return self.map[offset:offset + self.number_width].rstrip(b'\0')
+
+    def _name(self, record):
+        offset = INDEX_HEADER.size + record * self.width + self.number_width
+        return self.map[offset:offset + self.name_width].rstrip(b'\0')
+
+    def entry(self, record):
+        # (number, name) of a record
+        return self._number(record).decode('utf-8'), self._name(record).decode('utf-8')
+
+    def find(self, number):
+        # Record holding number, or None
+        key = number.encode('utf-8')
+        record = bisect.bisect_left(range(self.count), key, key=self._number)
+        if record < self.count and self._number(record) == key:
+            return record
+        return None
+
+    def with_prefix(self, prefix):
+        # Records whose number starts with prefix, in number order
+        key = prefix.encode('utf-8')
+        record = bisect.bisect_left(range(self.count), key, key=self._number)
+        while record < self.count and self._number(record).startswith(key):
+            yield record
+            record += 1
+
+    def named(self, name):
+        # Records registered under name, in the order they were registered
+        key = name.encode('utf-8')
+        by_name = self.by_name
+        i = bisect.bisect_left(range(self.count), key, key=lambda i: self._name(by_name[i]))
+        while i < self.count and self._name(by_name[i]) == key:
+            yield by_name[i]
+            i += 1
+
+    def names(self):
+        # (name, number) for every record, in name order
+        for record in self.by_name:
+            number, name = self.entry(record)
+            yield name, number
+
+
+class LazyPhoneDirectory(PhoneDirectory):
+    # A PhoneDirectory over a compiled PhoneIndex. A phone from the index only gets
+    # a Phone object the first time it is looked up; until then it is on-hook and
+    # untouched (so status changed leaves it out), and counts and listings read it
+    # straight from the index. Phones added, replaced or removed afterwards are
+    # tracked here, not in the file.
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+        self.deleted = set()   # Numbers from the index that have been removed
+        self.replaced = set()  # Numbers from the index given a different Phone since
+        self.extra = {}        # Numbers the index does not hold, in the order they were added
+        self.waking = threading.Lock()  # So threads looking up a new phone all get the same Phone
+
+    def _wake(self, number):
+        # The index's Phone for number, made now; None when it has none
+        if type(number) is not str or number in self.deleted or number in self.extra:
+            return None
+        record = self.index.find(number)
+        if record is None:
+            return None
+        with self.waking:
+            phone = dict.get(self, number)
+            if phone is None:
+                phone = Phone(number, self.index.entry(record)[1])
+                self.states[ONHOOK].add(phone)
+                dict.__setitem__(self, number, phone)
+        return phone
+
+    def _listed(self, number):
+        # Whether number's place in the directory comes from the index
+        return number not in self.deleted and number not in self.extra and self.index.find(number) is not None
+
+    def dormant(self):
+        # Phones from the index that have not been looked up yet
+        return len(self.index) - len(self.deleted) - (dict.__len__(self) - len(self.extra))
+
+    def get(self, number, default=None):
+        phone = dict.get(self, number)
+        if phone is None:
+            phone = self._wake(number)
+        return default if phone is None else phone
+
+    def __getitem__(self, number):
+        phone = self.get(number)
+        if phone is None:
+            raise KeyError(number)
+        return phone
+
+    def __contains__(self, number):
+        return dict.__contains__(self, number) or (type(number) is str and self._listed(number))
+
+    def __len__(self):
+        return len(self.index) - len(self.deleted) + len(self.extra)
+
+    def __iter__(self):
+        for number, _ in self.items():
+            yield number
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for _, phone in self.items():
+            yield phone
+
+    def items(self):
+        # Directory order; phones not looked up yet are listed as stand-ins that are
+        # not kept, so a full listing does not fill the directory
+        index = self.index
+        for record in index.order:
+            number, name = index.entry(record)
+            if number not in self.deleted:
+                yield number, dict.get(self, number) or Phone(number, name)
+        for number in list(self.extra):
+            yield number, dict.__getitem__(self, number)
+
+    def __setitem__(self, number, phone):
+        old = self.get(number)
+        if old is not None:
+            self._unindex(old)
+        if self._listed(number):
+            self.replaced.add(number)  # Keeps its place; its name now comes from phone
+        else:
+            self.extra[number] = None
+        dict.__setitem__(self, number, phone)
+        self._index(phone)
+
+    def __delitem__(self, number):
+        phone = self[number]
+        dict.__delitem__(self, number)
+        if number in self.extra:
+            del self.extra[number]
+        else:
+            self.deleted.add(number)
+            self.replaced.discard(number)
+        self._unindex(phone)
+
+    def popitem(self):
+        number = next(reversed(self.extra), None)
+        if number is None:
+            for record in reversed(self.index.order):
+                number = self.index.entry(record)[0]
+                if number not in self.deleted:
+                    break
+            else:
+                raise KeyError('popitem(): directory is empty')
+        return number, self.pop(number)
+
+    def clear(self):
+        super().clear()
+        self.index = PhoneIndex()
+        self.deleted.clear()
+        self.replaced.clear()
+        self.extra.clear()
+
+    def count(self, code):
+        count = len(self.states[code])
+        return count + self.dormant() if code == ONHOOK else count
+
+    def in_state(self, code):
+        if code == ONHOOK:
+            return [p for p in self.with_prefix('') if p.state_code == ONHOOK]
+        return super().in_state(code)
+
+    def with_prefix(self, prefix):
+        index = self.index
+        phones = []
+        for record in index.with_prefix(prefix):
+            number, name = index.entry(record)
+            if number not in self.deleted:
+                phones.append(dict.get(self, number) or Phone(number, name))
+        phones += [dict.__getitem__(self, number) for number in self.extra if number.startswith(prefix)]
+        return sorted(phones, key=lambda p: p.number)
+
+    def by_name(self, name):
+        for record in self.index.named(name):
+            number = self.index.entry(record)[0]
+            if number not in self.deleted and number not in self.replaced:
+                return self.get(number)
+        return super().by_name(name)
+
+    def duplicate_names(self):
+        found = {}
+        for name, number in self.index.names():
+            if number not in self.deleted and number not in self.replaced:
+                found.setdefault(name, []).append(number)
+        for name, holders in self.names.items():
+            found.setdefault(name, []).extend(p.number for p in holders)
+        return {name: numbers for name, numbers in found.items() if len(numbers) > 1}
@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import io
+import sys
+
+from main import AdmissionControl, TelephoneSystem, TextSink, run_command, run_timers
+from timers import Timeouts
+
+# Every command gets its response lines followed by this blank line, so clients
+# know where one response ends even when it spans several lines (status).
+END_OF_RESPONSE = "\n"
+
+
+class SwitchServer:
+    # Serves the console command grammar over TCP. All connections share one
+    # TelephoneSystem; commands run one at a time on the event loop, so they never
+    # interleave, and each connection only ever sees the output of its own commands.
+    def __init__(self, system, line_limit=4096):
+        self.system = system
+        self.line_limit = line_limit
+        self.connections = 0
+        self.commands = 0
+        self.timer_task = None  # Fires timeouts while the server runs, if the switch has them
+
+    def execute(self, command):
+        # Run one command with output captured for the connection that sent it
+        out = io.StringIO()
+        previous = self.system.sink
+        self.system.sink = TextSink(out)
+        try:
+            ran = run_command(self.system, command)
+        finally:
+            self.system.sink = previous
+        if not ran:
+            return None
+        self.commands += 1
+        return out.getvalue() + END_OF_RESPONSE
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (asyncio.LimitOverrunError, ValueError):
+                    break  # Line longer than line_limit; drop the client
+                if not line:
+                    break
+                response = self.execute(line.decode('utf-8', 'replace'))
+                if response is None:
+                    continue
+                writer.write(response.encode('utf-8'))
+                # Backpressure: a slow reader stops its own connection here, not the switch
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def fire_timers(self):
+        # Timeouts fire between commands even when no client is sending any; their
+        # output goes to the switch's own sink, not to a connection
+        while True:
+            await asyncio.sleep(self.system.timeouts.wheel.resolution)
+            run_timers(self.system)
+
+    async def start(self, host, port):
+        if self.system.timeouts is not None:
+            self.timer_task = asyncio.ensure_future(self.fire_timers())
+        return await asyncio.start_server(self.handle, host, port, limit=self.line_limit)
+
+
+async def serve(system, host, port):
+    switch = SwitchServer(system)
+    server = await switch.start(host, port)
+    addresses = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+    print(f"Serving on {addresses}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Telephone switch TCP server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4230)
+    parser.add_argument('--phones', default='phones.txt', help="directory file to load")
+    parser.add_argument('--restore', metavar='SNAPSHOT', help="start from a saved snapshot instead of the directory")
+    parser.add_argument('--ring-timeout', type=float, metavar='SEC',
+                        help="a phone that rings this long unanswered stops ringing")
+    parser.add_argument('--dialtone-timeout', type=float, metavar='SEC',
+                        help="a phone left offhook without a call this long is released")
+    parser.add_argument('--plan', metavar='FILE', help="route dialled numbers that are not phones by number plan FILE")
+    parser.add_argument('--call-rate', type=float, metavar='PER_SEC',
+                        help="most call setups (call, transfer, conference) per second across the switch")
+    parser.add_argument('--call-burst', type=float, metavar='N', help="setups the switch may take at once (default: the rate)")
+    parser.add_argument('--phone-call-rate', type=float, metavar='PER_SEC', help="most call setups per second from one phone")
+    parser.add_argument('--phone-call-burst', type=float, metavar='N', help="setups one phone may make at once (default: the rate)")
+    parser.add_argument('--history', type=int, metavar='N',
+                        help="keep each phone's last N state changes; '<phone> history' prints them")
+    parser.add_argument('--metrics', action='store_true',
+                        help="count command outcomes and latencies; the metrics command prints them")
+    args = parser.parse_args(argv)
+
+    timeouts = None
+    if args.ring_timeout is not None or args.dialtone_timeout is not None:
+        timeouts = Timeouts(ring=args.ring_timeout, dialtone=args.dialtone_timeout)
+    system = TelephoneSystem(sink=TextSink(sys.stderr), timeouts=timeouts)
+    if args.restore:
+        system.load_snapshot(args.restore)
+    else:
+        system.load_phones_bulk(args.phones)
+    if args.plan:
+        system.load_number_plan(args.plan)
+    if args.call_rate is not None or args.phone_call_rate is not None:
+        system.admission = AdmissionControl(args.call_rate, args.call_burst, args.phone_call_rate, args.phone_call_burst)
+    if args.history:
+        system.enable_history(args.history)
+    if args.metrics:
+        system.enable_metrics()
+    try:
+        asyncio.run(serve(system, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
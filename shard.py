@@ -0,0 +1,472 @@
+import argparse
+import io
+import multiprocessing
+import random
+import sys
+import time
+
+from bench import synthetic_directory
+from main import (CALL_DEPTH, EVENT_TEXT, STATE_COUNTS, STATUS, Conference, ListSink, Phone, TelephoneSystem, TextSink,
+                  call_links, report_throughput, run_batch, run_command, switch_form)
+
+# Phones are partitioned across worker processes by number prefix. A command whose
+# phones (and every phone linked to them through current_call or ringing_from) all
+# live on one shard runs there. Anything else is a cross-shard command: the
+# coordinator pulls the linked phones out of their shards, runs the command on a
+# scratch TelephoneSystem so the ringing/answer/failure logic is exactly the
+# single-process one, and hands the results back to the owning shards. Switch
+# commands (status in all its forms, and the reports) go to every shard, and the
+# coordinator merges the answers.
+#
+# Commands are sent to the shards in windows. Shards run their part of a window
+# until they meet a cross-shard command. Local commands that a shard ran past the
+# earliest such command are undone and run again after it, so every command
+# observes the same state it would in a single process.
+
+
+def shard_of(number, shards, prefix_len=1):
+    prefix = number[:prefix_len]
+    return int(prefix) % shards if prefix.isdigit() else 0
+
+
+def phone_record(phone):
+    # Call state of a phone with every reference replaced by a number
+    call = phone.current_call
+    if call is None:
+        ref = None
+    elif isinstance(call, Conference):
+        # Conference participants, and the (invitee, inviter) pairs still ringing
+        ref = (tuple(p.number for p in call),
+               tuple((invitee.number, inviter.number) for invitee, inviter in call.pending.items()))
+    else:
+        ref = call.number
+    ringing = None if phone.ringing_from is None else phone.ringing_from.number
+    return phone.number, phone.state_code, phone.call_type_code, ref, ringing
+
+
+def apply_records(records, resolve):
+    # Inverse of phone_record; phones listing the same bridge share one Conference again
+    conferences = {}
+    for number, state, call_type, ref, ringing in records:
+        phone = resolve(number)
+        phone.state_code = state
+        phone.call_type_code = call_type
+        if ref is None:
+            phone.current_call = None
+        elif isinstance(ref, tuple):
+            participants = conferences.get(ref)
+            if participants is None:
+                members, pending = ref
+                participants = conferences[ref] = Conference(resolve(n) for n in members)
+                for invitee, inviter in pending:
+                    participants.invite(resolve(invitee), resolve(inviter))
+            phone.current_call = participants
+        else:
+            phone.current_call = resolve(ref)
+        phone.ringing_from = None if ringing is None else resolve(ringing)
+
+
+class ShardWorker:
+    # One shard: owns some phones and keeps stand-ins for the remote phones they link to
+    def __init__(self, entries):
+        self.out = io.StringIO()
+        self.system = TelephoneSystem(sink=TextSink(self.out))
+        self.system.phones = {number: Phone(number, name) for number, name in entries}
+        self.stubs = {}  # Remote phones referenced from this shard, by number
+        self.pending = []  # This window's commands for the shard
+        self.next = 0      # Position in pending of the next command to run
+        self.undo = []     # (index, saved phone fields, saved conference members) per command run this window
+
+    def resolve(self, number, names):
+        phone = self.system.phones.get(number) or self.stubs.get(number)
+        if phone is None:
+            phone = self.stubs[number] = Phone(number, names[number])
+        return phone
+
+    def closure(self, starts):
+        # Phones within the given number of links of each start ({number: links}).
+        # Returns the local phones reached, how many links were left at each, and
+        # the remote numbers reached with the links left there.
+        phones = self.system.phones
+        local, reach, remote = [], {}, {}
+        stack = list(starts.items())
+        while stack:
+            number, hops = stack.pop()
+            phone = phones.get(number)
+            if phone is None:
+                if remote.get(number, -1) < hops:
+                    remote[number] = hops
+                continue
+            if reach.get(number, -1) >= hops:
+                continue
+            if number not in reach:
+                local.append(phone)
+            reach[number] = hops
+            if hops:
+                stack.extend((other.number, hops - 1) for other in call_links(phone))
+        return local, reach, remote
+
+    def queue(self, commands):
+        # Start a window: (index, text, numbers) commands, in order
+        self.pending = commands
+        self.next = 0
+        self.undo = []
+
+    def run(self, after):
+        # Run queued commands after index in order, until one reaches another shard
+        pending = self.pending
+        while self.next < len(pending) and pending[self.next][0] <= after:
+            self.next += 1
+        out = self.out
+        out.seek(0)
+        out.truncate()
+        ends = []  # (index, end offset of its output in out)
+        stopped = None
+        while self.next < len(pending):
+            index, text, numbers = pending[self.next]
+            local, _, remote = self.closure(dict.fromkeys(numbers, CALL_DEPTH))
+            if remote:
+                stopped = index
+                break
+            bridges = {id(p.current_call): p.current_call for p in local if isinstance(p.current_call, Conference)}
+            changed = self.system.phones.changed
+            self.undo.append((index,
+                              [(p, p.state_code, p.call_type_code, p.current_call, p.ringing_from, p in changed)
+                               for p in local],
+                              [(bridge, dict(bridge.members), dict(bridge.pending), bridge in changed)
+                               for bridge in bridges.values()]))
+            run_command(self.system, text)
+            ends.append((index, out.tell()))
+            self.next += 1
+        text = out.getvalue()
+        done = []
+        start = 0
+        for index, end in ends:
+            done.append((index, text[start:end]))
+            start = end
+        return done, stopped
+
+    def rollback(self, index):
+        # Undo every command of this window that came after index; they will run again
+        while self.undo and self.undo[-1][0] > index:
+            _, phones, bridges = self.undo.pop()
+            changed = self.system.phones.changed
+            for phone, state, call_type, call, ringing, was_changed in phones:
+                phone.state_code = state
+                phone.call_type_code = call_type
+                phone.current_call = call
+                phone.ringing_from = ringing
+                self.system.phones.refile(phone, changed=False)
+                # Bridges the undone command made may still be marked; they are unreachable now
+                (changed.add if was_changed else changed.discard)(phone)
+            for bridge, members, pending, was_changed in bridges:
+                bridge.members = members
+                bridge.pending = pending
+                (changed.add if was_changed else changed.discard)(bridge)
+            self.next -= 1
+        self.undo = []
+
+    def export(self, starts):
+        local, reach, remote = self.closure(starts)
+        return [phone_record(p) for p in local], reach, remote
+
+    def load(self, records, names, changed):
+        # Take back phones a cross-shard command ran on; changed are the numbers
+        # it marked changed, as the single process would have
+        apply_records(records, lambda number: self.resolve(number, names))
+        phones = self.system.phones
+        for record in records:
+            phones.refile(phones[record[0]], changed=record[0] in changed)
+
+    def query(self, text):
+        # Run a switch command on this shard's phones. Status lines come back as
+        # (number, line) and state counts as a dict, for the coordinator to merge;
+        # any other event comes back as its text.
+        previous = self.system.sink
+        sink = self.system.sink = ListSink()
+        try:
+            run_command(self.system, text)
+        finally:
+            self.system.sink = previous
+        results = []
+        for event, args in sink.events:
+            if event == STATUS:
+                results.append((event, args))
+            elif event == STATE_COUNTS:
+                results.append((event, args[0]))
+            else:
+                results.append((event, EVENT_TEXT[event](*args)))
+        return results
+
+
+def shard_main(conn, entries):
+    worker = ShardWorker(entries)
+    while True:
+        op, args, reply = conn.recv()
+        if op == 'stop':
+            break
+        result = getattr(worker, op)(*args)
+        if reply:
+            conn.send(result)
+
+
+class ShardedSwitch:
+    # Coordinator: routes commands to the shard owning their phones and runs
+    # cross-shard commands itself. directory is a loaded TelephoneSystem used
+    # only to resolve identifiers and to keep the directory order for status.
+    def __init__(self, directory, shards=4, prefix_len=1, window=1024):
+        self.directory = directory
+        self.shards = shards
+        self.window = window
+        self.owner = {}
+        self.names = {}
+        self.order = {}
+        entries = [[] for _ in range(shards)]
+        for position, (number, phone) in enumerate(directory.phones.items()):
+            shard = shard_of(number, shards, prefix_len)
+            self.owner[number] = shard
+            self.names[number] = phone.name
+            self.order[number] = position
+            entries[shard].append((number, phone.name))
+        self.conns = []
+        self.procs = []
+        for shard in range(shards):
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=shard_main, args=(child, entries[shard]), daemon=True)
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('stop', (), False))
+        for proc in self.procs:
+            proc.join()
+
+    def numbers(self, parts):
+        # Numbers of the phones a command names, resolved the way find_phone would
+        identifiers = parts[:1] + parts[2:3]
+        found = (self.directory.find_phone(identifier) for identifier in identifiers)
+        return [phone.number for phone in found if phone is not None]
+
+    def is_switch_command(self, words):
+        # The same test Command.run makes: a switch verb with arguments yields to a phone of that name
+        return switch_form(words) is not None and (len(words) == 1 or not self.directory.find_phone(words[0]))
+
+    def run_switch(self, text):
+        # Switch command: every shard answers for its own phones and the answers are
+        # merged. Plain status lists phones in directory order and filtered status
+        # in number order, as a single process would; state counts are summed.
+        # Other reports describe switch-wide features, which the shards are all
+        # built without, so the first shard's answer stands for all of them.
+        for conn in self.conns:
+            conn.send(('query', (text,), True))
+        answers = [conn.recv() for conn in self.conns]
+        lines = [payload for answer in answers for event, payload in answer if event == STATUS]
+        if len(text.split()) == 1:
+            lines.sort(key=lambda entry: self.order[entry[0]])
+        else:
+            lines.sort()
+        counts = None
+        for answer in answers:
+            for event, payload in answer:
+                if event == STATE_COUNTS:
+                    counts = {name: (counts or {}).get(name, 0) + count for name, count in payload.items()}
+        merged = [line for _, line in lines]
+        if counts is not None:
+            merged.append(EVENT_TEXT[STATE_COUNTS](counts))
+        merged += [payload for event, payload in answers[0] if event not in (STATUS, STATE_COUNTS)]
+        return ''.join(line + "\n" for line in merged)
+
+    def run_global(self, text, numbers):
+        # Cross-shard command: gather the phones it can touch, run it here, return the results
+        records = {}
+        reach = {}
+        wanted = dict.fromkeys(numbers, CALL_DEPTH)
+        while wanted:
+            requests = {}
+            for number, hops in wanted.items():
+                requests.setdefault(self.owner[number], {})[number] = hops
+            for shard, starts in requests.items():
+                self.conns[shard].send(('export', (starts,), True))
+            wanted = {}
+            for shard in requests:
+                found, found_reach, remote = self.conns[shard].recv()
+                records.update((record[0], record) for record in found)
+                for number, hops in found_reach.items():
+                    reach[number] = max(hops, reach.get(number, -1))
+                for number, hops in remote.items():
+                    if hops > reach.get(number, -1) and hops > wanted.get(number, -1):
+                        wanted[number] = hops
+        out = io.StringIO()
+        scratch = TelephoneSystem(sink=TextSink(out))
+        scratch.phones = {number: Phone(number, self.names[number]) for number in sorted(records, key=self.order.get)}
+        # Phones that records point at but the command cannot reach only need to exist
+        outside = {}
+        def resolve(number):
+            phone = scratch.phones.get(number) or outside.get(number)
+            if phone is None:
+                phone = outside[number] = Phone(number, self.names[number])
+            return phone
+        apply_records(records.values(), resolve)
+        scratch.phones.changed = set()  # Only what the command itself changes
+        run_command(scratch, text)
+        changed = {phone.number for phone in scratch.phones.take_changed()}
+        updates = {}
+        for phone in scratch.phones.values():
+            updates.setdefault(self.owner[phone.number], []).append(phone_record(phone))
+        names = {number: self.names[number] for number in (*scratch.phones, *outside)}
+        for shard, shard_records in updates.items():
+            self.conns[shard].send(('load', (shard_records, names, changed), False))
+        return out.getvalue()
+
+    def run_window(self, batch, out):
+        # batch: list of (text, numbers, home shard); outputs are written in order
+        work = {}
+        for index, (text, numbers, home) in enumerate(batch):
+            work.setdefault(home, []).append((index, text, numbers))
+        for shard, commands in work.items():
+            self.conns[shard].send(('queue', (commands,), False))
+        busy = set(work)
+        after = -1
+        while busy:
+            for shard in busy:
+                self.conns[shard].send(('run', (after,), True))
+            outputs = {}
+            stop = None
+            ran_to = {}
+            for shard in busy:
+                done, stopped = self.conns[shard].recv()
+                outputs.update(done)
+                ran_to[shard] = done[-1][0] if done else -1
+                if stopped is None:
+                    ran_to[shard] = len(batch)
+                elif stop is None or stopped < stop:
+                    stop = stopped
+            end = len(batch) if stop is None else stop
+            out.write(''.join(outputs[index] for index in range(after + 1, end)))
+            if stop is None:
+                return
+            for shard in list(busy):
+                if ran_to[shard] > stop:
+                    # Ran past the cross-shard command: undo those and run them again after it
+                    self.conns[shard].send(('rollback', (stop,), False))
+                elif ran_to[shard] == len(batch):
+                    busy.discard(shard)
+            text, numbers, _ = batch[stop]
+            out.write(self.run_global(text, numbers))
+            after = stop
+            busy.add(batch[stop][2])
+
+    def run(self, source, out):
+        # Replay commands like run_batch; returns (commands, seconds)
+        count = 0
+        batch = []
+        start = time.perf_counter()
+        for line in source:
+            text = line.strip()
+            if not text:
+                continue
+            count += 1
+            words = text.split()
+            if self.is_switch_command(words):
+                self.run_window(batch, out)
+                batch = []
+                out.write(self.run_switch(text))
+                continue
+            numbers = self.numbers(words)
+            home = self.owner[numbers[0]] if numbers else 0
+            batch.append((text, numbers, home))
+            if len(batch) >= self.window:
+                self.run_window(batch, out)
+                batch = []
+        self.run_window(batch, out)
+        return count, time.perf_counter() - start
+
+
+def synthetic_workload(numbers, shard, count, locality, seed):
+    # Interleaved call scripts; with probability locality both ends share a shard
+    rng = random.Random(seed)
+    by_shard = {}
+    for number in numbers:
+        by_shard.setdefault(shard(number), []).append(number)
+    active = []
+    commands = []
+    while len(commands) < count:
+        if len(active) < 64:
+            a = rng.choice(numbers)
+            b, c = (rng.choice(by_shard[shard(a)] if rng.random() < locality else numbers) for _ in range(2))
+            script = [f"{a} offhook", f"{a} call {b}", f"{b} offhook"]
+            if rng.random() < 0.1:
+                script += [f"{a} transfer {c}", f"{c} offhook", f"{c} onhook"]
+            elif rng.random() < 0.1:
+                script += [f"{a} conference {c}", f"{c} offhook", f"{c} onhook"]
+            script += [f"{a} onhook", f"{b} onhook"]
+            active.append(script)
+        script = active[rng.randrange(len(active))]
+        commands.append(script.pop(0))
+        if not script:
+            active.remove(script)
+    return commands
+
+
+def compare(size, count, shards, locality, window, seed):
+    # Throughput of the single-process engine against the sharded one on the same traffic
+    directory = synthetic_directory(size)
+    numbers = list(directory.phones)
+    commands = synthetic_workload(numbers, lambda n: shard_of(n, shards), count, locality, seed) + ["status"]
+
+    single = synthetic_directory(size)
+    single_out = io.StringIO()
+    single_count, single_time = run_batch(single, commands, single_out)
+
+    switch = ShardedSwitch(directory, shards=shards, window=window)
+    try:
+        sharded_out = io.StringIO()
+        sharded_count, sharded_time = switch.run(commands, sharded_out)
+    finally:
+        switch.close()
+
+    for label, done, elapsed in (("single process", single_count, single_time),
+                                 (f"{shards} shards", sharded_count, sharded_time)):
+        print(f"{label:>15}: {done} commands in {elapsed:.3f}s ({done / elapsed:.0f} commands/sec)")
+    same = single_out.getvalue() == sharded_out.getvalue()
+    print(f"outputs identical: {'yes' if same else 'NO'}")
+    return same
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded multi-process telephone switch")
+    parser.add_argument('--phones', default='phones.txt', help="directory file to load")
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--prefix', type=int, default=1, help="number prefix length used to pick a shard")
+    parser.add_argument('--window', type=int, default=1024, help="commands sent to the shards at a time")
+    parser.add_argument('--batch', default='-', metavar='FILE', help="commands to replay (default stdin)")
+    parser.add_argument('--compare', type=int, metavar='PHONES',
+                        help="instead of replaying, compare throughput with the single-process engine "
+                             "on a synthetic directory of PHONES phones")
+    parser.add_argument('--commands', type=int, default=200000, help="synthetic commands for --compare")
+    parser.add_argument('--locality', type=float, default=0.9, help="share of synthetic calls within one shard")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare, args.commands, args.shards, args.locality, args.window, args.seed)
+        return
+
+    directory = TelephoneSystem(sink=TextSink(sys.stderr))
+    directory.load_phones_bulk(args.phones)
+    switch = ShardedSwitch(directory, shards=args.shards, prefix_len=args.prefix, window=args.window)
+    try:
+        if args.batch == '-':
+            count, elapsed = switch.run(sys.stdin, sys.stdout)
+        else:
+            with open(args.batch, 'r') as source:
+                count, elapsed = switch.run(source, sys.stdout)
+    finally:
+        switch.close()
+    report_throughput(count, elapsed)
+
+
+if __name__ == "__main__":
+    main()
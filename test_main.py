@@ -1,5 +1,19 @@
+import asyncio
+import io
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
-from main import TelephoneSystem, Phone
+from main import TelephoneSystem, Phone, AdmissionControl, SHED, HISTORY, RINGING, NORMAL, EventSink, ONHOOK, parse_command, phone_command, PHONE_COMMANDS, run_command, run_batch, run_timers, ListSink, NullSink, TextSink, HEARS, TALKING, CONNECTED, LOAD_REJECTS, LEFT_CONFERENCE
+from cdr import CallRecords
+from concurrency import ConcurrentSwitch
+from journal import Journal, replay_journal, read_journal
+from timers import ManualClock, TimerWheel, Timeouts
+import bench
+from server import SwitchServer
+from shard import ShardedSwitch, phone_record
 
 class TestTelephoneSystem(unittest.TestCase):
     def setUp(self):
@@ -189,6 +203,723 @@ class TestTelephoneSystem(unittest.TestCase):
         # Confirm Bob and Charlie are in the "offhook" or "connected" state
         self.assertIn(self.system.phones["23456"].state, ["connected", "offhook"])  # Bob should still be in the call.
         self.assertIn(self.system.phones["34567"].state, ["connected", "offhook"])  # Charlie should still be in the call.
-    
+
+    # Name index: lookups by name stay in step with adds and removes
+    def test_find_phone_by_name_index(self):
+        self.assertIs(self.system.find_phone("Bob"), self.system.phones["23456"])
+        self.system.phones["67890"] = Phone("67890", "Dave")  # Add a phone after setup.
+        self.assertIs(self.system.find_phone("Dave"), self.system.phones["67890"])
+        del self.system.phones["23456"]  # Remove Bob.
+        self.assertIsNone(self.system.find_phone("Bob"))
+        self.system.phones |= {"78901": Phone("78901", "Erin")}
+        self.assertIs(self.system.find_phone("Erin"), self.system.phones["78901"])
+        copy = self.system.phones.copy()
+        self.assertIs(copy.by_name("Erin"), self.system.phones["78901"])
+        self.assertEqual(copy.count(ONHOOK), len(self.system.phones))
+
+    # Name index: duplicate names are found when the index is built
+    def test_duplicate_names_reported(self):
+        self.system.phones["67890"] = Phone("67890", "Alice")
+        self.assertEqual(self.system.phones.duplicate_names(), {"Alice": ["12345", "67890"]})
+        self.assertEqual(self.system.find_phone("Alice").number, "12345")  # First Alice wins, as before.
+        self.system.phones.pop("12345")
+        self.assertEqual(self.system.find_phone("Alice").number, "67890")
+
+    # Batch mode: commands are replayed without prompts and output is buffered
+    def test_batch_replay(self):
+        commands = io.StringIO("12345 offhook\n\n12345 call 23456\nBob offhook\nstatus\nbogus\n")
+        out = io.StringIO()
+        count, elapsed = run_batch(self.system, commands, out)
+        self.assertEqual(count, 5)  # Blank lines are not counted.
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "Alice hears dialtone.")
+        self.assertIn("Alice and Bob are talking.", lines)
+        self.assertEqual(lines[-1], "Invalid command.")
+        self.assertEqual(self.system.phones["23456"].state, "connected")
+
+    # Event sinks: typed events instead of printed text
+    def test_event_sinks(self):
+        sink = ListSink()
+        self.system.sink = sink
+        self.system.offhook("12345")
+        self.system.call("12345", "23456")
+        self.system.pickup("23456")
+        self.assertEqual(sink.drain(), [
+            (HEARS, ("Alice", "dialtone")),
+            (HEARS, ("Alice", "ringback")),
+            (HEARS, ("Bob", "ringing")),
+            (TALKING, ("Alice", "Bob")),
+        ])
+        self.system.sink = NullSink()  # Events can be dropped entirely.
+        self.system.onhook("12345")
+        self.assertEqual(self.system.phones["23456"].state, "offhook")
+
+    # Buffered text sink holds lines until flushed and matches the console text
+    def test_buffered_text_sink(self):
+        out = io.StringIO()
+        self.system.sink = TextSink(out, buffer_size=1 << 16)
+        self.system.offhook("Alice")
+        self.system.offhook("99999")
+        self.assertEqual(out.getvalue(), "")
+        self.system.sink.flush()
+        self.assertEqual(out.getvalue(), "Alice hears dialtone.\nPhone 99999 not found.\n")
+
+    # Compact phones: slotted, with integer state codes behind the string names
+    def test_compact_phone_state_codes(self):
+        phone = self.system.phones["12345"]
+        self.assertFalse(hasattr(phone, "__dict__"))
+        self.system.pickup("12345")
+        self.assertEqual(phone.state, "offhook")
+        with self.assertRaises(AttributeError):
+            phone.state = "connected"  # Would leave the per-state sets behind.
+        self.system.phones.set_state(phone, CONNECTED)
+        self.assertEqual(phone.state, "connected")
+        self.assertEqual(str(phone), "Alice (12345): connected")
+        self.assertEqual(self.system.state_counts()["connected"], 1)
+
+    # Bulk loader: same rules as load_phones, rejects aggregated with line numbers
+    def test_load_phones_bulk(self):
+        lines = ["12345 Alice", "", "1234 Short", "23456 Bob Smith", "justoneword",
+                 "   34567   Charlie  ", "45678 Averyverylongname", "56789 J0hn", "67890 Dave"]
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write("\n".join(lines))
+        self.addCleanup(os.remove, f.name)
+        expected = TelephoneSystem(sink=NullSink())
+        expected.load_phones(f.name)
+        bulk = TelephoneSystem(sink=ListSink())
+        loaded, rejects = bulk.load_phones_bulk(f.name, block_size=7)  # Tiny blocks split lines.
+        self.assertEqual(loaded, 3)
+        self.assertEqual(list(bulk.phones), list(expected.phones))
+        self.assertEqual(rejects, [(3, "1234 Short"), (4, "23456 Bob Smith"),
+                                   (7, "45678 Averyverylongname"), (8, "56789 J0hn")])
+        self.assertEqual([e for e, args in bulk.sink.events].count(LOAD_REJECTS), 1)
+
+    # Snapshot: live call state survives a save and restore
+    def test_snapshot_restore(self):
+        self.system.sink = NullSink()
+        self.system.pickup("12345")
+        self.system.call("12345", "23456")
+        self.system.pickup("23456")
+        self.system.conference("12345", "34567")
+        self.system.pickup("34567")  # Alice, Bob and Charlie share one participant list.
+        self.system.pickup("45678")
+        self.system.call("45678", "56789")  # Sally is ringing John.
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+            pass
+        self.addCleanup(os.remove, f.name)
+        self.system.save_snapshot(f.name)
+        restored = TelephoneSystem(sink=NullSink())
+        restored.load_snapshot(f.name)
+        self.assertEqual([str(p) for p in restored.phones.values()],
+                         [str(p) for p in self.system.phones.values()])
+        alice, bob = restored.phones["12345"], restored.phones["23456"]
+        self.assertIs(alice.current_call, bob.current_call)
+        self.assertIs(restored.phones["56789"].ringing_from, restored.phones["45678"])
+        self.assertIs(restored.find_phone("John"), restored.phones["56789"])
+        restored.pickup("John")  # The restored switch carries on where it left off.
+        self.assertEqual(restored.phones["45678"].state, "connected")
+
+    # Per-state indexes: sets follow every transition; status can be filtered
+    def test_state_indexes_and_filtered_status(self):
+        sink = ListSink()
+        self.system.sink = sink
+        self.system.status()
+        sink.drain()
+        self.system.pickup("12345")
+        self.system.call("12345", "23456")
+        self.system.pickup("23456")
+        self.system.conference("12345", "34567")
+        self.system.pickup("34567")
+        self.system.onhook("12345")  # Conference reverts to Bob and Charlie.
+        self.system.pickup("45678")
+        self.system.call("45678", "56789")
+        phones = self.system.phones
+        for code, members in enumerate(phones.states):
+            self.assertEqual(members, {p for p in phones.values() if p.state_code == code})
+        self.assertEqual(self.system.state_counts()["connected"], 2)
+
+        def listed(**kwargs):
+            sink.drain()
+            self.system.status(**kwargs)
+            return [args[0] for _, args in sink.drain()]
+
+        self.assertEqual(listed(changed=True), ["12345", "23456", "34567", "45678", "56789"])
+        self.assertEqual(listed(changed=True), [])  # Nothing changed since.
+        self.system.pickup("56789")
+        self.assertEqual(listed(changed=True), ["45678", "56789"])
+        self.assertEqual(listed(state="connected"), ["23456", "34567", "45678", "56789"])
+        self.assertEqual(listed(prefix="3"), ["34567"])
+        self.assertEqual(listed(state="onhook", prefix="1"), ["12345"])
+
+    # Status queries from the console
+    def test_status_queries_from_console(self):
+        out = io.StringIO()
+        run_batch(self.system, ["12345 offhook", "status offhook", "status summary", "status 2", "status bogus"], out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "Alice hears dialtone.",
+            "Alice (12345): offhook",
+            "onhook: 4, offhook: 1, ringing: 0, dialing: 0, calling: 0, connected: 0",
+            "Bob (23456): onhook",
+            "Invalid command.",
+        ])
+
+    # Conference bridges: configurable size, O(1) join and leave, same 3-party behaviour
+    def test_large_conference_bridge(self):
+        system = TelephoneSystem(sink=ListSink(), conference_limit=5)
+        system.phones = {f"1000{i}": Phone(f"1000{i}", name)
+                         for i, name in enumerate(["Ann", "Ben", "Cat", "Dan", "Eve", "Fay"])}
+        system.pickup("Ann")
+        system.call("Ann", "Ben")
+        system.pickup("Ben")
+        for name in ("Cat", "Dan", "Eve"):
+            system.conference("Ann", name)
+            system.pickup(name)
+        self.assertEqual(system.participant_count("Ben"), 5)
+        self.assertEqual(str(system.find_phone("Ben")), "Ben (10001): connected (talking to Ann, Cat, Dan, Eve)")
+        system.conference("Ann", "Fay")  # Bridge is full.
+        self.assertEqual(system.find_phone("Fay").state, "onhook")
+        system.onhook("Eve")
+        system.conference("Ann", "Fay")
+        system.onhook("Fay")  # Fay does not answer; Ann goes back to the bridge.
+        self.assertEqual(system.find_phone("Ann").state, "connected")
+        self.assertEqual(system.participant_count("Ann"), 4)
+        system.sink.drain()
+        system.onhook("Dan")
+        system.onhook("Cat")  # Two left: back to a normal call.
+        self.assertEqual(system.sink.drain()[-3:-1], [(TALKING, ("Ann", "Ben")), (LEFT_CONFERENCE, ("Cat",))])
+        self.assertIs(system.find_phone("Ann").current_call, system.find_phone("Ben"))
+        self.assertEqual(system.participant_count("Ann"), 0)
+
+    # A party being added is not on the bridge until it answers, whoever leaves meanwhile
+    def test_members_leave_while_add_pending(self):
+        system = TelephoneSystem(sink=ListSink(), conference_limit=5)
+        system.phones = {f"1000{i}": Phone(f"1000{i}", name) for i, name in enumerate(["Ann", "Ben", "Cat", "Dan"])}
+        system.pickup("Ann")
+        system.call("Ann", "Ben")
+        system.pickup("Ben")
+        system.conference("Ann", "Cat")
+        system.pickup("Cat")
+        system.conference("Ann", "Dan")  # Dan is ringing.
+        self.assertEqual(str(system.find_phone("Ben")), "Ben (10001): connected (talking to Ann, Cat)")
+        system.sink.drain()
+        system.onhook("Ben")
+        self.assertEqual(system.participant_count("Cat"), 2)  # Kept for the pending add.
+        system.onhook("Cat")
+        self.assertNotIn(TALKING, [event for event, _ in system.sink.drain()])
+        self.assertEqual((system.find_phone("Ann").state, system.find_phone("Dan").state), ("calling", "ringing"))
+        system.pickup("Dan")  # Only now are Ann and Dan talking.
+        self.assertEqual(system.sink.drain(), [(TALKING, ("Ann", "Dan"))])
+        for name in ("Ann", "Ben", "Cat", "Dan"):
+            system.onhook(name)
+        system.pickup("Ann")
+        system.call("Ann", "Ben")
+        system.pickup("Ben")
+        system.conference("Ann", "Cat")
+        system.pickup("Cat")
+        system.conference("Ann", "Dan")
+        system.onhook("Ann")  # The inviter leaves: Dan stops ringing, Ben and Cat carry on.
+        self.assertEqual(system.find_phone("Dan").state, "offhook")
+        self.assertIsNone(system.find_phone("Dan").ringing_from)
+        self.assertIs(system.find_phone("Ben").current_call, system.find_phone("Cat"))
+
+
+    # Journal: snapshot plus journal tail rebuilds the switch after a crash
+    def test_journal_replay_after_crash(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        journal_file = os.path.join(directory.name, "switch.journal")
+        snapshot_file = os.path.join(directory.name, "switch.bin")
+        self.system.sink = NullSink()
+        journal = Journal(journal_file, group_size=3, window=60)
+        run_batch(self.system, ["12345 offhook", "status", "bogus command here", "Sally call 99999",
+                                "12345 call 23456"], execute=journal.run)
+        self.assertEqual(journal.commits, 0)  # Only commands that changed a phone count towards the group.
+        run_batch(self.system, ["Bob offhook"], execute=journal.run)
+        self.assertEqual(journal.commits, 1)
+        self.system.save_snapshot(snapshot_file)  # Covers entries 1-3.
+        run_batch(self.system, ["12345 conference 34567", "Charlie offhook", "Sally offhook"], execute=journal.run)
+        journal.close()
+        with open(journal_file, 'ab') as f:
+            f.write(b"8\tSally call John\tSal")  # Torn write from the crash.
+        self.assertEqual([entry[:2] for entry in read_journal(journal_file, after=5)], [(6, "Sally offhook")])
+
+        restored = TelephoneSystem(sink=NullSink())
+        restored.load_snapshot(snapshot_file)
+        self.assertEqual(restored.journal_sequence, 3)
+        self.assertEqual(replay_journal(restored, journal_file, verify=True), (3, []))
+        self.assertEqual([str(p) for p in restored.phones.values()],
+                         [str(p) for p in self.system.phones.values()])
+        reopened = Journal(journal_file, window=0.01)  # Numbering carries on after the last whole entry.
+        self.assertEqual(reopened.sequence, 6)
+        run_batch(self.system, ["Sally onhook"], execute=reopened.run)
+        for _ in range(500):  # The window runs out with no further command to notice it.
+            if reopened.commits:
+                break
+            time.sleep(0.01)
+        self.assertEqual([entry[:2] for entry in read_journal(journal_file, after=6)], [(7, "Sally onhook")])
+        reopened.close()
+
+
+    # Timeouts: unanswered ringing and abandoned dialtone resolve on virtual time
+    def test_ring_and_dialtone_timeouts(self):
+        clock = ManualClock()
+        system = TelephoneSystem(sink=ListSink(), timeouts=Timeouts(ring=20, dialtone=10, clock=clock))
+        system.phones = self.system.phones
+        run_batch(system, ["12345 offhook", "12345 call 23456", "23456 offhook",
+                           "12345 transfer 34567"], out=io.StringIO())
+        system.pickup("Sally")
+        out = io.StringIO()
+        run_batch(system, ["Sally timeout"], out=out)  # Only the switch itself can expire a timer.
+        self.assertEqual(out.getvalue(), "Invalid command.\n")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        journal_file = os.path.join(directory.name, "switch.journal")
+        journal = Journal(journal_file)
+        clock.advance(15)
+        self.assertEqual(run_timers(system, journal.run), 1)  # Sally's dialtone; Charlie has 5s of ringing left.
+        journal.close()
+        self.assertEqual(system.find_phone("Sally").state, "onhook")
+        replayed = TelephoneSystem(sink=NullSink())
+        replayed.phones = {"45678": Phone("45678", "Sally")}
+        replayed.pickup("Sally")
+        self.assertEqual(replay_journal(replayed, journal_file, verify=True), (1, []))  # The expiry replays.
+        self.assertEqual(replayed.find_phone("Sally").state, "onhook")
+        clock.advance(5)
+        system.sink.drain()
+        self.assertEqual(run_timers(system), 1)
+        self.assertEqual(system.sink.drain(), [("no_answer", ("Charlie",)), ("transfer_failed", ("Charlie",)),
+                                               (TALKING, ("Alice", "Bob"))])
+        self.assertEqual(system.find_phone("Alice").state, "connected")
+        clock.advance(60)
+        self.assertEqual(run_timers(system), 0)  # Connected phones have no timers.
+        system.onhook("Bob")
+        clock.advance(10)
+        self.assertEqual(run_timers(system), 1)  # Alice was left on silence.
+        self.assertEqual(system.find_phone("Alice").state, "onhook")
+
+    def test_timer_wheel_levels(self):
+        wheel = TimerWheel(resolution=1)
+        deadlines = {key: (key * 7919) % 200000 + 1 for key in range(2000)}  # Spans three levels.
+        for key, when in deadlines.items():
+            wheel.arm(key, when)
+        for key in range(0, 2000, 2):
+            wheel.cancel(key)
+        wheel.arm(1, 5)  # Re-arming replaces the old timer.
+        deadlines[1] = 5
+        fired = []
+        for now in range(0, 200000 + 997, 997):
+            for key, _ in wheel.advance(now):
+                self.assertTrue(now - 997 < deadlines[key] <= now)
+                fired.append(key)
+        self.assertEqual(sorted(fired), list(range(1, 2000, 2)))
+        self.assertEqual(fired, sorted(fired, key=deadlines.get))
+        self.assertEqual(len(wheel), 0)
+
+    def test_timer_wheel_deadline_on_level_boundary(self):
+        for deadline in (256, 512, 65536):  # Deadlines a cascade moves straight to the lowest level.
+            wheel = TimerWheel(resolution=1)
+            wheel.arm("a", deadline)
+            self.assertEqual(wheel.advance(deadline - 1), [])
+            self.assertEqual(wheel.advance(deadline), [("a", None)])
+
+
+    # Metrics: outcome counters and latency histograms, only while enabled
+    def test_metrics(self):
+        out = io.StringIO()
+        metrics = self.system.enable_metrics()
+        run_batch(self.system, ["12345 offhook", "12345 call 23456", "45678 offhook", "45678 call 23456",
+                                "23456 offhook", "23456 transfer 34567", "34567 onhook"], out=out)
+        data = metrics.snapshot()
+        self.assertEqual(data['outcomes'][("call", "ringback")], 1)
+        self.assertEqual(data['outcomes'][("call", "busy")], 1)
+        self.assertEqual(data['outcomes'][("onhook", "transfer_failed")], 1)
+        self.assertEqual(data['latency']['pickup']['count'], 3)
+        self.assertEqual(sum(data['latency']['pickup']['buckets']), 3)
+        out = io.StringIO()
+        run_batch(self.system, ["metrics"], out=out)
+        self.assertIn('switch_outcomes_total{command="call",outcome="busy"} 1', out.getvalue())
+        self.assertIn('switch_latency_us_count{command="call"} 2', out.getvalue())
+        self.system.disable_metrics()
+        self.assertNotIn("call", vars(self.system))  # Back to the plain methods.
+        self.system.sink = ListSink()
+        self.system.report_metrics()
+        self.assertEqual(self.system.sink.events, [("metrics", (None,))])
+
+
+    # Parsed commands: dispatch table, lookups kept between runs, pluggable verbs
+    def test_parsed_commands(self):
+        sink = ListSink()
+        self.system.sink = sink
+        pickup, hangup = parse_command("Alice offhook"), parse_command("12345 ONHOOK")
+        for _ in range(2):
+            pickup.run(self.system)
+            hangup.run(self.system)
+        self.assertIs(pickup.operands[0], self.system.phones["12345"])  # Looked up once.
+        self.assertEqual([e for e, args in sink.drain()], [HEARS, "now_onhook"] * 2)
+        self.system.phones["67890"] = Phone("67890", "Alice")  # Directory changed: look up again.
+        pickup.run(self.system)
+        self.assertEqual(self.system.phones["12345"].state, "offhook")
+        self.assertIsNone(parse_command("   "))
+        run_command(self.system, parse_command("Zed call Bob"))  # Shown as typed.
+        self.assertEqual(sink.drain()[-1], ("caller_not_found", ("Zed",)))
+        run_command(self.system, "12345 frobnicate")
+        self.assertEqual(sink.drain(), [("invalid_command", ())])
+
+        phone_command("ring", 1, lambda system, phone, target: system.call(phone, target))
+        self.addCleanup(PHONE_COMMANDS.pop, "ring")
+        run_command(self.system, "Alice ring Bob")  # A new verb, no change to the loop.
+        self.assertEqual(self.system.phones["23456"].state, "ringing")
+
+    # Call detail records: one row per call, written in chunks, queried by column
+    def test_call_detail_records(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        clock = ManualClock(7 * 3600)
+        self.system.sink = NullSink()
+        self.system.cdrs = CallRecords(directory.name, chunk_rows=2, clock=clock)
+        for command in ["12345 offhook", "12345 call 23456", "+", "23456 offhook", "+", "+",
+                        "23456 onhook", "12345 onhook",            # Completed: 20s talking.
+                        "12345 offhook", "12345 call 34567", "12345 onhook",  # Missed.
+                        "12345 offhook", "12345 call 23456", "23456 offhook", "+",
+                        "12345 transfer 45678", "45678 offhook", "+", "23456 onhook",
+                        "45678 onhook"]:
+            if command == "+":
+                clock.advance(10)
+            else:
+                run_command(self.system, command)
+        self.system.cdrs.flush()
+
+        cdrs = CallRecords(directory.name)  # Reopened from the chunk files alone.
+        self.assertEqual(len(cdrs), 4)
+        counts = cdrs.outcome_counts()
+        self.assertEqual((counts['completed'], counts['missed'], counts['transferred']), (2, 1, 1))
+        self.assertEqual(cdrs.calls_per_phone()["12345"], 3)
+        self.assertEqual(cdrs.busy_hours()[7], 4)
+        self.assertEqual(cdrs.average_hold_time(), (20 + 10 + 10) / 3)
+        self.assertEqual(cdrs.failed_transfer_rate(), 0.0)
+
+    def test_conferenced_record_closes_after_fallback(self):
+        self.system.sink = NullSink()
+        records = self.system.cdrs = CallRecords()
+        run_batch(self.system, ["12345 offhook", "12345 call 23456", "23456 offhook",
+                                "12345 conference 34567", "34567 offhook",
+                                "12345 onhook", "23456 onhook", "34567 onhook"], out=io.StringIO())
+        self.assertEqual(records.talking, {})  # Charlie's record closed when Bob hung up.
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records.outcome_counts()['conferenced'], 1)
+
+
+    # Number plan: ranges, wildcard routes and hunt groups for numbers that are not phones
+    def test_number_plan(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, "plan.txt")
+        with open(filename, "w") as file:
+            file.write("# Sales answers 4xxxx, except the 41000-41099 block, which is Bob's\n"
+                       "4xxxx sales\n41000-41099 Bob\ngroup sales Charlie 45678\n")  # Routes may come first.
+        plan = self.system.load_number_plan(filename)
+        self.assertEqual((plan.routes, plan.target("41042"), plan.target("41100").name), (2, "Bob", "sales"))
+        sink = ListSink()
+        self.system.sink = sink
+        self.system.offhook("12345")
+        self.system.call("12345", "41042")  # Range route to one phone.
+        self.assertEqual(self.system.phones["23456"].state, "ringing")
+        self.system.offhook("56789")
+        self.system.call("56789", "40000")  # Hunt group: Charlie is idle.
+        self.system.offhook("45678")
+        self.system.call("45678", "47777")  # Charlie is ringing now; Sally is next but dialling herself.
+        self.assertEqual(self.system.phones["34567"].ringing_from.name, "John")
+        self.assertEqual(sink.events[-1], (HEARS, ("Sally", "busy")))
+        self.system.onhook("45678")
+        self.system.pickup("23456")  # Bob answers Alice.
+        self.system.transfer("12345", "40001")  # Sally is idle again and gets the transfer.
+        self.assertEqual(self.system.phones["45678"].state, "ringing")
+        self.system.call("56789", "50000")
+        self.assertEqual(sink.events[-1], (HEARS, ("John", "denial")))  # No route.
+        with self.assertRaises(ValueError):
+            plan.add_route("4000-41000", "Bob")
+
+    # Admission control: call setups beyond the token buckets hear congestion
+    def test_admission_control(self):
+        clock = ManualClock()
+        control = AdmissionControl(rate=3, phone_rate=1, phone_burst=2, clock=clock)
+        self.system.admission = control
+        sink = ListSink()
+        self.system.sink = sink
+        self.system.call("12345", "23456")  # Alice is onhook: fails anyway, so takes no token.
+        for _ in range(3):  # Alice's burst of two, then one too many.
+            self.system.offhook("12345")
+            self.system.call("12345", "23456")
+            self.system.onhook("12345")  # Hang-ups are never limited.
+            self.system.onhook("23456")
+        self.assertEqual(sink.events[-3:-1], [(SHED, ("Alice",)), ("now_onhook", ("Alice",))])
+        self.system.offhook("34567")
+        self.system.call("34567", "45678")  # Third token for the switch.
+        self.system.pickup("45678")  # Answers are never limited.
+        self.system.conference("34567", "12345")
+        self.assertEqual(sink.drain()[-1], (SHED, ("Charlie",)))  # Switch bucket is empty.
+        clock.advance(1)
+        self.system.conference("34567", "12345")
+        self.assertEqual(self.system.phones["12345"].state, "ringing")
+        counts = control.counts()
+        self.assertEqual(counts["admitted"], {"call": 3, "transfer": 0, "conference": 1})
+        self.assertEqual((counts["shed"]["call", "phone"], counts["shed"]["conference", "switch"]), (1, 1))
+        out = io.StringIO()
+        run_batch(self.system, ["admission"], out=out)
+        self.assertIn("call: 3 admitted, 1 shed by phone limit, 0 by switch limit", out.getvalue())
+
+    # Phone history: each phone keeps its last few state changes for troubleshooting
+    def test_phone_history(self):
+        clock = ManualClock()
+        self.system.enable_history(depth=3, clock=clock)
+        self.system.offhook("12345")
+        clock.advance(1)
+        self.system.call("12345", "23456")
+        self.system.pickup("23456")
+        clock.advance(1)
+        self.system.transfer("12345", "34567")
+        self.system.onhook("12345")  # Five changes: the oldest two have been overwritten.
+        self.assertEqual(self.system.phone_history("Alice"), [
+            (1, "calling", "connected", "normal"), (2, "connected", "calling", "transfer"),
+            (2, "calling", "onhook", "transfer")])
+        self.assertEqual(self.system.phone_history("12345", 1), [(2, "calling", "onhook", "transfer")])
+        self.assertEqual(self.system.phone_history("Sally"), [])  # Never changed state.
+        self.assertIsNone(self.system.phone_history("99999"))
+        self.system.phones["67890"] = Phone("67890", "Dave")
+        self.system.pickup("Sally")
+        self.system.call("Sally", "John")
+        self.system.pickup("John")
+        self.system.conference("Sally", "Dave")
+        self.system.pickup("Dave")  # John stays connected: nothing new to record.
+        self.assertEqual(self.system.phone_history("John")[-1][1:3], ("ringing", "connected"))
+        sink = ListSink()
+        self.system.sink = sink
+        self.system.report_history("Charlie")
+        self.assertEqual(sink.events, [(HISTORY, (self.system.phones["34567"], [(2, ONHOOK, RINGING, NORMAL)]))])
+        out = io.StringIO()
+        run_batch(self.system, ["Alice history"], out=out)
+        self.assertIn("connected -> calling (transfer)", out.getvalue())
+
+    # Lazy directory: phones come from a compiled index only as they are used
+    def test_lazy_phone_index(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source, index = os.path.join(directory.name, "phones.txt"), os.path.join(directory.name, "phones.idx")
+        with open(source, "w") as file:
+            file.write("23456 Bob\n12345 Alice\n34567 Charlie\nbad line\n45678 Alice\n")
+        sink = ListSink()
+        system = TelephoneSystem(sink=sink)
+        system.compile_phone_index(source, index)
+        self.assertIn(("load_rejects", ([(4, "bad line")],)), sink.events)
+        system.open_phone_index(index)
+        phones = system.phones
+        self.addCleanup(phones.index.close)
+        self.assertEqual((len(phones), dict.__len__(phones)), (4, 0))  # Nothing made yet.
+        self.assertEqual(list(phones), ["23456", "12345", "34567", "45678"])  # Directory order.
+        self.assertIs(system.find_phone("Alice"), phones["12345"])  # First registered.
+        self.assertIsNone(system.find_phone("99999"))
+        run_batch(system, ["Alice offhook", "Alice call Bob"], out=io.StringIO())
+        self.assertEqual(dict.__len__(phones), 2)
+        self.assertEqual(system.state_counts()["onhook"], 2)
+        self.assertEqual([p.number for p in phones.in_state(ONHOOK)], ["34567", "45678"])
+        del phones["12345"]
+        phones["56789"] = Phone("56789", "Alice")
+        self.assertEqual(system.find_phone("Alice").number, "45678")
+        self.assertEqual(phones.duplicate_names(), {"Alice": ["45678", "56789"]})
+        self.assertEqual([p.number for p in phones.with_prefix("")], ["23456", "34567", "45678", "56789"])
+
+
+class YieldingSink(EventSink):
+    # Gives up the interpreter on every event, so other threads run in the middle of a command
+    def emit(self, event, *args):
+        time.sleep(0)
+
+    def flush(self):
+        pass
+
+class LoggedSwitch(ConcurrentSwitch):
+    # Records commands in the order they ran with their phones locked
+    def __init__(self, system):
+        super().__init__(system)
+        self.log = []
+
+    def execute(self, command):
+        self.log.append(" ".join(command.words))
+        super().execute(command)
+
+class TestConcurrentSwitch(unittest.TestCase):
+    # Commands from many threads: per-phone locks leave the switch as some serial order would
+    def directory(self):
+        return {str(10000 + i): Phone(str(10000 + i), "N" + chr(ord("a") + i)) for i in range(12)}
+
+    def hammer(self, verbs, threads=8, commands=1000):
+        system = TelephoneSystem(sink=YieldingSink())
+        system.phones = self.directory()
+        switch = LoggedSwitch(system)
+        identifiers = list(system.phones) + ["Na", "Nb"]
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(commands):
+                    verb = rng.choice(verbs)
+                    target = " " + rng.choice(identifiers) if verb in ("call", "transfer", "conference") else ""
+                    switch.run(f"{rng.choice(identifiers)} {verb}{target}")
+                    if rng.random() < 0.02:
+                        switch.run("status")
+            except Exception as error:
+                errors.append(error)
+
+        workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+        serial = TelephoneSystem(sink=NullSink())
+        serial.phones = self.directory()
+        for command in switch.log:
+            run_command(serial, command)
+        self.assertEqual([phone_record(p) for p in system.phones.values()],
+                         [phone_record(p) for p in serial.phones.values()])
+        for code, members in enumerate(system.phones.states):
+            self.assertTrue(all(p.state_code == code for p in members))
+        return system
+
+    def test_plain_calls_stay_symmetric(self):
+        system = self.hammer(["offhook", "onhook", "call"])
+        for phone in system.phones.values():
+            if phone.state_code == CONNECTED:
+                self.assertIs(phone.current_call.current_call, phone)
+
+    def test_transfers_and_conferences(self):
+        self.hammer(["offhook", "onhook", "call", "transfer", "conference"])
+
+    def test_lock_order(self):
+        system = TelephoneSystem(sink=NullSink())
+        system.phones = self.directory()
+        switch = ConcurrentSwitch(system)
+        for command in ("10000 offhook", "10000 call 10001", "10002 offhook", "10002 call 10003", "10003 offhook"):
+            switch.run(command)
+        reach = lambda *identifiers: sorted(switch.reach([system.find_phone(i) for i in identifiers]))
+        self.assertEqual(reach("10001"), ["10000", "10001"])
+        self.assertEqual(reach("Nc", "10004"), ["10002", "10003", "10004"])  # Unrelated to 10000/10001.
+        self.assertEqual(sorted(switch.locks), ["10000", "10001", "10002", "10003"])
+        self.assertTrue(all(not lock.locked() for lock in switch.locks.values()))
+        switch.run("10002 conference 10004")  # 10004 rings, pending on 10002 and 10003's bridge.
+        self.assertEqual(reach("10003"), ["10002", "10003", "10004"])
+
+
+class TestBenchmark(unittest.TestCase):
+    # Benchmark suite: seeded traffic is reproducible and regressions are flagged
+    def test_traffic_is_seeded(self):
+        system = bench.synthetic_directory(50)
+        self.assertEqual(bench.generate_traffic(system, 500, seed=7), bench.generate_traffic(system, 500, seed=7))
+        self.assertNotEqual(bench.generate_traffic(system, 500, seed=7), bench.generate_traffic(system, 500, seed=8))
+
+    def test_regressions_against_baseline(self):
+        result = bench.bench_size(50, 2000, seed=1, memory=False)
+        self.assertEqual(result['ops'], 2000)
+        baseline = {"50": dict(result, ops_per_sec=result['ops_per_sec'] * 2)}
+        found = bench.regressions([result], baseline, tolerance=0.2)
+        self.assertEqual(len(found), 1)
+        self.assertIn("ops/sec", found[0])
+        self.assertEqual(bench.regressions([result], {"50": result}, tolerance=0.2), [])
+
+class TestShardedSwitch(unittest.TestCase):
+    # Sharded switch: same output as one process, including calls across shards
+    def test_matches_single_process(self):
+        commands = ["12345 offhook", "12345 call 56789", "John offhook",  # Shards 1 and 1 (prefixes 1 and 5).
+                    "23456 offhook", "23456 call 34567", "34567 offhook",  # Shards 0 and 1.
+                    "12345 conference 23456", "23456 offhook", "12345 conference 45678",
+                    "status ringing", "status summary", "status changed", "status 2",  # Every shard answers.
+                    "Sally offhook", "status", "56789 transfer 45678", "Sally onhook",
+                    "23456 onhook", "12345 onhook", "Charlie onhook", "status", "metrics", "admission"]
+        phones = os.path.join(os.path.dirname(os.path.abspath(__file__)), "phones.txt")
+        single = TelephoneSystem(sink=NullSink())
+        single.load_phones(phones)
+        expected = io.StringIO()
+        run_batch(single, commands, expected)
+
+        directory = TelephoneSystem(sink=NullSink())
+        directory.load_phones(phones)
+        for window in (1, 4, 64):
+            switch = ShardedSwitch(directory, shards=2, window=window)
+            try:
+                out = io.StringIO()
+                switch.run(commands, out)
+            finally:
+                switch.close()
+            self.assertEqual(out.getvalue(), expected.getvalue())
+
+    def test_pending_invitation_across_shards(self):
+        # Hal and Ann share a shard; Gus, being invited to their bridge, is on another
+        commands = ["Hal offhook", "Hal call Ann", "Ann offhook", "Hal conference Gus", "Hal onhook", "status"]
+        phones = {"48888": Phone("48888", "Hal"), "10001": Phone("10001", "Ann"), "37777": Phone("37777", "Gus")}
+        single = TelephoneSystem(sink=NullSink())
+        single.phones = phones
+        expected = io.StringIO()
+        run_batch(single, commands, expected)
+        self.assertIn("Gus hears silence.", expected.getvalue())
+        directory = TelephoneSystem(sink=NullSink())
+        directory.phones = {number: Phone(number, phone.name) for number, phone in phones.items()}
+        switch = ShardedSwitch(directory, shards=3, window=1)
+        try:
+            out = io.StringIO()
+            switch.run(commands, out)
+        finally:
+            switch.close()
+        self.assertEqual(out.getvalue(), expected.getvalue())
+
+    def test_cross_shard_command_marks_only_what_it_changed(self):
+        # Gus (on hook) calling Dan on another shard changes nothing, so after the first
+        # status changed (which lists the freshly loaded phones) neither is listed again
+        commands = ["status changed", "Dan onhook", "Gus call Dan", "status changed", "Gus offhook", "Gus call Dan", "status changed"]
+        phones = {"10001": Phone("10001", "Dan"), "37777": Phone("37777", "Gus")}
+        single = TelephoneSystem(sink=NullSink())
+        single.phones = phones
+        expected = io.StringIO()
+        run_batch(single, commands, expected)
+        directory = TelephoneSystem(sink=NullSink())
+        directory.phones = {number: Phone(number, phone.name) for number, phone in phones.items()}
+        for window in (1, 4):
+            switch = ShardedSwitch(directory, shards=3, window=window)
+            try:
+                out = io.StringIO()
+                switch.run(commands, out)
+            finally:
+                switch.close()
+            self.assertEqual(out.getvalue(), expected.getvalue())
+
+class TestSwitchServer(unittest.IsolatedAsyncioTestCase):
+    # Network front end: each connection gets the responses to its own commands
+    async def test_concurrent_connections(self):
+        system = TelephoneSystem(sink=NullSink())
+        system.phones = {"12345": Phone("12345", "Alice"), "23456": Phone("23456", "Bob")}
+        server = await SwitchServer(system).start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            alice = await asyncio.open_connection("127.0.0.1", port)
+            bob = await asyncio.open_connection("127.0.0.1", port)
+
+            async def send(connection, command):
+                reader, writer = connection
+                writer.write(command.encode() + b"\n")
+                await writer.drain()
+                lines = []
+                while (line := await reader.readline()) != b"\n":
+                    lines.append(line.decode().rstrip("\n"))
+                return lines
+
+            self.assertEqual(await send(alice, "12345 offhook"), ["Alice hears dialtone."])
+            self.assertEqual(await send(alice, "12345 call Bob"), ["Alice hears ringback.", "Bob hears ringing."])
+            self.assertEqual(await send(bob, "Bob offhook"), ["Alice and Bob are talking."])
+            self.assertEqual(await send(bob, "nonsense"), ["Invalid command."])
+            for _, writer in (alice, bob):
+                writer.close()
+                await writer.wait_closed()
+        self.assertEqual(system.phones["12345"].state, "connected")
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,130 @@
+import math
+import time
+
+from main import OFFHOOK, RINGING
+
+# Timing wheel geometry: TIMER_LEVELS wheels of 2**TIMER_BITS slots, each slot of
+# a level spanning a whole turn of the level below
+TIMER_BITS = 8
+TIMER_SLOTS = 1 << TIMER_BITS
+TIMER_MASK = TIMER_SLOTS - 1
+TIMER_LEVELS = 4
+
+class TimerWheel:
+    # Hierarchical timing wheel. Time is counted in ticks of `resolution` seconds; a
+    # timer lands in the lowest level whose turn reaches its deadline, and moves down
+    # a level each time the level below wraps around. Arm and cancel are O(1) dict
+    # operations, and advance only visits the slots time actually passes through.
+    # Each key has at most one timer; arming it again replaces the old one.
+    def __init__(self, resolution=0.1, start=0.0):
+        self.resolution = resolution
+        self.tick = math.floor(start / resolution)  # Last tick processed
+        self.levels = [[{} for _ in range(TIMER_SLOTS)] for _ in range(TIMER_LEVELS)]
+        self.counts = [0] * TIMER_LEVELS  # Timers held by each level
+        self.where = {}  # key -> (level, slot dict) holding its timer
+
+    def __len__(self):
+        return len(self.where)
+
+    def arm(self, key, when, value=None):
+        # Fire key with value once the clock reaches `when` seconds
+        self.cancel(key)
+        self._place(key, math.ceil(when / self.resolution), value, self.tick + 1)  # Already due: next advance
+
+    def cancel(self, key):
+        found = self.where.pop(key, None)
+        if found is not None:
+            level, slot = found
+            del slot[key]
+            self.counts[level] -= 1
+
+    def _place(self, key, deadline, value, earliest):
+        # earliest is the first tick still to be processed
+        deadline = max(deadline, earliest)
+        for level in range(TIMER_LEVELS):
+            shift = TIMER_BITS * level
+            if (deadline >> shift) - (self.tick >> shift) < TIMER_SLOTS:
+                break
+        # Beyond the top level's turn the slot is reused early, which only means the
+        # timer is placed again sooner than it needs to be
+        slot = self.levels[level][(deadline >> shift) & TIMER_MASK]
+        slot[key] = (deadline, value)
+        self.where[key] = (level, slot)
+        self.counts[level] += 1
+
+    def _cascade(self, tick):
+        # Move the timers of every level whose turn starts at tick down a level
+        top = 1
+        while top < TIMER_LEVELS and not tick & ((1 << (TIMER_BITS * top)) - 1):
+            top += 1
+        for level in range(top - 1, 0, -1):
+            slots = self.levels[level]
+            index = (tick >> (TIMER_BITS * level)) & TIMER_MASK
+            slot = slots[index]
+            if slot:
+                slots[index] = {}
+                self.counts[level] -= len(slot)
+                for key, (deadline, value) in slot.items():
+                    self._place(key, deadline, value, tick)  # tick itself is processed next
+
+    def advance(self, now):
+        # Move time forward to `now` seconds; returns the (key, value) of every timer
+        # that fired, in deadline order
+        target = math.floor(now / self.resolution)
+        expired = []
+        slots = self.levels[0]
+        while self.tick < target:
+            if not self.where:
+                self.tick = target
+                break
+            if self.counts[0]:
+                self.tick += 1
+            else:
+                # Nothing on the lowest wheel: jump to where the next level cascades
+                self.tick = min((self.tick | TIMER_MASK) + 1, target)
+            tick = self.tick
+            if not tick & TIMER_MASK:
+                self._cascade(tick)
+            index = tick & TIMER_MASK
+            slot = slots[index]
+            if slot:
+                slots[index] = {}
+                self.counts[0] -= len(slot)
+                for key, (deadline, value) in slot.items():
+                    del self.where[key]
+                    expired.append((key, value))
+        return expired
+
+
+class ManualClock:
+    # A clock that only moves when told to, for driving timeouts deterministically
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class Timeouts:
+    # No-answer and abandoned-dialtone timers for one switch. Every state change arms
+    # or cancels the phone's timer: ringing arms the no-answer timer, offhook (dialtone
+    # or silence) the dialtone timer, anything else cancels. A delay of None disables
+    # that timer. clock is any callable returning seconds.
+    def __init__(self, ring=30.0, dialtone=15.0, clock=time.monotonic, resolution=0.1):
+        self.delays = {code: delay for code, delay in ((RINGING, ring), (OFFHOOK, dialtone)) if delay is not None}
+        self.clock = clock
+        self.wheel = TimerWheel(resolution, clock())
+
+    def transition(self, phone, code):
+        delay = self.delays.get(code)
+        if delay is not None:
+            self.wheel.arm(phone, self.clock() + delay, code)
+        elif phone in self.wheel.where:
+            self.wheel.cancel(phone)
+
+    def expire(self):
+        # Phones whose timer ran out, oldest deadline first
+        return [phone for phone, code in self.wheel.advance(self.clock()) if phone.state_code == code]